@@ -0,0 +1,61 @@
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import tornado.ioloop
+
+import auth
+import tasks
+import team
+import task_gen
+from configuration import configuration
+from shared_state import shared_state
+
+
+# Coroutine versions of the blocking data-access functions (SQLite queries, file reads, task
+# generation). They run in a bounded thread pool, so a slow disk
+# only delays the requests that wait for it instead of the whole IOLoop
+executor = ThreadPoolExecutor(max_workers=configuration['io_workers'], thread_name_prefix='io')
+
+
+def run_in_executor(func, *args, **kwargs):
+    # Returns an awaitable, must be called from the IOLoop thread
+    return tornado.ioloop.IOLoop.current().run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+def catch_up_and_load_session(session_id):
+    # Every request loads the session first, so this is where changes made by other worker
+    # processes (logouts, solves, admin changes) are picked up before in-memory state is used
+    if shared_state.poll_on_request:
+        shared_state.poll()
+    return auth.load_session(session_id)
+
+
+async def load_session(session_id):
+    return await run_in_executor(catch_up_and_load_session, session_id)
+
+
+async def read_team(team_name):
+    return await run_in_executor(team.read_team, team_name)
+
+
+async def get_task_list():
+    return await run_in_executor(lambda: list(tasks.get_task_list()))
+
+
+async def get_generated_task(task_id, token, tm):
+    return await run_in_executor(task_gen.get_generated_task, task_id, token, tm)
+
+
+async def get_generated_task_list(team_name):
+    return await run_in_executor(lambda: list(task_gen.get_generated_task_list(team_name=team_name)))
+
+
+async def add_submission(team_name, task_id, flag, is_correct, points):
+    return await run_in_executor(
+        team.add_submission,
+        team_name = team_name,
+        task_id = task_id,
+        flag = flag,
+        is_correct = is_correct,
+        points = points,
+    )
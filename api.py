@@ -56,6 +56,7 @@ class Api:
             raise ApiKeyError(name)
         if access_level < required_access_level:
             raise ApiPermissionError(lc.get('api_call_not_allowed').format(api_func=name))
-        func(self, session, args)
+        # Coroutine handlers return an awaitable, which the caller has to await
+        return func(self, session, args)
 
 api = Api()
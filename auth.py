@@ -1,19 +1,26 @@
 # -*- coding: utf-8 -*-
 
-import sqlite3
 import hashlib
 import time
 import os
 import json
 import secrets
 import re
-import copy
-from contextlib import closing
+from threading import Lock
+from collections import OrderedDict
 
 from loguru import logger
 
+import aio
+import database
+import hashing
+import task_gen
+import prewarm
+import signed_sessions
 from configuration import configuration
 from localization import lc
+from scoreboard import scoreboard
+from shared_state import shared_state
 from api import api, GUEST, USER, ADMIN, ApiArgumentError
 
 
@@ -51,32 +58,91 @@ class RegValidationFailedError(BaseRegistrationError):
 
 
 class SessionCache:
+    # At most session_cache_size sessions, the least recently used are evicted. Sessions are also
+    # indexed by username, so invalidating a team's sessions does not scan the whole cache.
+    # Expired sessions are dropped on lookup and by sweep_expired(), which main calls periodically
     def __init__(self):
-        self.cache = {}
+        self.lock = Lock()
+        self.cache = OrderedDict()
+        self.by_username = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def discard(self, session_id):
+        # Must be called with the lock held
+        session = self.cache.pop(session_id, None)
+        if session is None:
+            return
+        session_ids = self.by_username[session.username]
+        session_ids.discard(session_id)
+        if len(session_ids) == 0:
+            del self.by_username[session.username]
 
     def add(self, session):
-        self.cache[session.id] = session
+        with self.lock:
+            self.discard(session.id)
+            self.cache[session.id] = session
+            self.by_username.setdefault(session.username, set()).add(session.id)
+            while len(self.cache) > configuration['session_cache_size']:
+                self.discard(next(iter(self.cache)))
+                self.evictions += 1
 
     def remove(self, session_id):
-        del self.cache[session_id]
+        with self.lock:
+            self.discard(session_id)
 
     def remove_for(self, username):
-        for k, v in copy.deepcopy(self.cache).items():
-            if v.username == username:
-                del self.cache[k]
+        with self.lock:
+            for session_id in list(self.by_username.get(username, [])):
+                self.discard(session_id)
 
     def get(self, session_id):
-        if session_id not in self.cache:
-            return None
-        if self.cache[session_id].expires_at <= time.time():
-            self.cache.pop(session_id)
-            return None
-        return self.cache[session_id]
+        with self.lock:
+            session = self.cache.get(session_id)
+            if session is not None and session.expires_at <= time.time():
+                self.discard(session_id)
+                self.expirations += 1
+                session = None
+            if session is None:
+                self.misses += 1
+                return None
+            self.cache.move_to_end(session_id)
+            self.hits += 1
+            return session
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.by_username.clear()
 
     def maybe_set_admin(self, username, value):
-        for k, v in self.cache.items():
-            if v.username == username:
-                v.is_admin = value
+        with self.lock:
+            for session_id in self.by_username.get(username, []):
+                self.cache[session_id].is_admin = value
+
+    def sweep_expired(self):
+        with self.lock:
+            now = time.time()
+            expired = [session_id for session_id, session in self.cache.items() if session.expires_at <= now]
+            for session_id in expired:
+                self.discard(session_id)
+            self.expirations += len(expired)
+        if len(expired) > 0:
+            logger.debug('Removed {} expired sessions from the cache', len(expired))
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'size':        len(self.cache),
+                'max_size':    configuration['session_cache_size'],
+                'teams':       len(self.by_username),
+                'hits':        self.hits,
+                'misses':      self.misses,
+                'evictions':   self.evictions,
+                'expirations': self.expirations,
+            }
 
 
 def hash_session_id(session_id):
@@ -84,23 +150,36 @@ def hash_session_id(session_id):
 
 
 def hash_password(password):
-    return apply_secure_hash(password.encode())
+    return hashing.hash_password(password)
 
 
 def apply_secure_hash(data):
     return configuration['secure_hash_function'](data).hexdigest()
 
 
+def is_signed_mode():
+    return configuration['session_mode'] == 'signed'
+
+
+def load_signed_session(token):
+    payload = signed_sessions.verify_token(token)
+    if payload is None:
+        return None
+    return Session(token, payload['u'], payload['e'], payload['a'])
+
+
 def load_session(session_id):
     if session_id is None:
         return None
+    if is_signed_mode():
+        return load_signed_session(session_id)
     cached_session = session_cache.get(session_id)
     if cached_session is not None:
         return cached_session
 
     session_id_hash = hash_session_id(session_id)
 
-    with closing(sqlite3.connect(configuration['db_path'])) as db:
+    with database.connect() as db:
         cur = db.cursor()
         cur.execute(
             'SELECT username, expires FROM sessions WHERE expires > ? AND session_id_hash = ? LIMIT 1',
@@ -123,16 +202,21 @@ def load_session(session_id):
 
 def logout(session_id):
     logger.info('Deleting session {}'.format(session_id))
+    if is_signed_mode():
+        signed_sessions.revocation_list.revoke_token(session_id)
+        shared_state.bump('sessions')
+        return
     session_cache.remove(session_id)
     session_id_hash = hash_session_id(session_id)
-    with closing(sqlite3.connect(configuration['db_path'])) as db:
+    with database.connect() as db:
         cur = db.cursor()
         cur.execute('DELETE FROM sessions WHERE session_id_hash = ?', (session_id_hash,))
         db.commit()
+    shared_state.bump('sessions')
 
 
 def get_user_info(username):
-    with closing(sqlite3.connect(configuration['db_path'])) as db:
+    with database.connect() as db:
         cur = db.cursor()
         cur.execute('SELECT full_name, email, is_admin FROM users WHERE username = ? LIMIT 1', (username,))
         full_name, email, is_admin = cur.fetchone()
@@ -143,11 +227,20 @@ def get_user_info(username):
         }
 
 
+def create_signed_session(username):
+    expires_at = int(time.time()) + configuration['session_duration']
+    is_admin = get_user_info(username)['is_admin']
+    token = signed_sessions.issue_token(username, is_admin, expires_at)
+    return Session(token, username, expires_at, is_admin)
+
+
 def create_session(username):
+    if is_signed_mode():
+        return create_signed_session(username)
     session_id = secrets.token_hex(32)
     session_id_hash = hash_session_id(session_id)
     expires_at = int(time.time()) + configuration['session_duration']
-    with closing(sqlite3.connect(configuration['db_path'])) as db:
+    with database.connect() as db:
         cur = db.cursor()
         cur.execute('DELETE FROM sessions WHERE expires < ?', (int(time.time()),))
         cur.execute('INSERT INTO sessions VALUES (?, ?, ?)', (session_id_hash, username, expires_at))
@@ -159,7 +252,7 @@ def create_session(username):
 
 
 def get_user_list():
-    with closing(sqlite3.connect(configuration['db_path'])) as db:
+    with database.connect() as db:
         cur = db.cursor()
         cur.execute('SELECT username FROM users')
         ls = cur.fetchall()
@@ -168,22 +261,16 @@ def get_user_list():
 
 
 def authenticate_user(username, password):
-    password_hash = hash_password(password)
-    with closing(sqlite3.connect(configuration['db_path'])) as db:
-        cur = db.cursor()
-        cur.execute(
-            'SELECT rowid FROM users WHERE username = ? AND password_hash = ? LIMIT 1',
-            (username, password_hash)
+    # Runs a key derivation function, prefer calling it through hashing.run_in_pool()
+    if not verify_password(username, password):
+        logger.info('Failed login attempt: username "{}", password "{}"'.format(
+            username,
+            '<hidden>' if configuration['hide_password_in_logs'] else password)
         )
-        if len(cur.fetchall()) == 0:
-            logger.info('Failed login attempt: username "{}", password "{}"'.format(
-                username,
-                '<hidden>' if configuration['hide_password_in_logs'] else password)
-            )
-            raise AuthenticationError()
-        else:
-            logger.info('User "{}" logged in'.format(username))
-            return create_session(username)
+        raise AuthenticationError()
+    else:
+        logger.info('User "{}" logged in'.format(username))
+        return create_session(username)
 
 
 def validate_user_creds(username, disp_name, email):
@@ -203,7 +290,7 @@ def register_user(username, password, disp_name, email=None, is_admin=False):
         email = None
     password_hash = hash_password(password)
     token_seed = secrets.token_hex(16)
-    with closing(sqlite3.connect(configuration['db_path'])) as db:
+    with database.connect() as db:
         cur = db.cursor()
         cur.execute(
             'SELECT rowid FROM users WHERE username = ? LIMIT 1',
@@ -217,18 +304,32 @@ def register_user(username, password, disp_name, email=None, is_admin=False):
             'INSERT INTO users VALUES (?, ?, ?, ?, ?, ?)',
             (username, password_hash, disp_name, email, is_admin, token_seed)
         )
+        cur.execute('INSERT OR IGNORE INTO team_points (team_name) VALUES (?)', (username,))
         db.commit()
+    scoreboard.add_team(username, disp_name)
+    shared_state.bump('scoreboard', key=username)
+    shared_state.bump('registrations', key=username)
+    prewarm.prewarmer.notify_team(username)
 
 
 def verify_password(user, passwd):
-    password_hash = hash_password(passwd)
-    with closing(sqlite3.connect(configuration['db_path'])) as db:
+    with database.connect() as db:
         cur = db.cursor()
-        cur.execute(
-            'SELECT rowid FROM users WHERE username = ? AND password_hash = ? LIMIT 1',
-            (user, password_hash)
-        )
-        return len(cur.fetchall()) > 0
+        cur.execute('SELECT password_hash FROM users WHERE username = ? LIMIT 1', (user,))
+        result = cur.fetchone()
+    if result is None or not hashing.verify_password(passwd, result[0]):
+        return False
+    if hashing.needs_rehash(result[0]):
+        logger.info('Upgrading password hash for user {}', user)
+        password_hash = hash_password(passwd)
+        with database.connect() as db:
+            cur = db.cursor()
+            cur.execute(
+                'UPDATE users SET password_hash = ? WHERE username = ? AND password_hash = ?',
+                (password_hash, user, result[0])
+            )
+            db.commit()
+    return True
 
 
 def update_password(user, passwd):
@@ -238,14 +339,14 @@ def update_password(user, passwd):
         '<hidden>' if configuration['hide_password_in_logs'] else passwd
     )
     password_hash = hash_password(passwd)
-    with closing(sqlite3.connect(configuration['db_path'])) as db:
+    with database.connect() as db:
         cur = db.cursor()
         cur.execute('UPDATE users SET password_hash = ? WHERE username = ?', (password_hash, user))
         db.commit()
 
 
 def team_exists(team_name):
-    with closing(sqlite3.connect(configuration['db_path'])) as db:
+    with database.connect() as db:
         cur = db.cursor()
         cur.execute('SELECT rowid FROM users WHERE username = ? LIMIT 1', (team_name,))
         return len(cur.fetchall()) > 0
@@ -258,11 +359,14 @@ def logout_team(team_name):
         'Terminating all session of team {}',
         team_name,
     )
-    with closing(sqlite3.connect(configuration['db_path'])) as db:
+    with database.connect() as db:
         cur = db.cursor()
         cur.execute('DELETE FROM sessions WHERE username = ?', (team_name,))
         db.commit()
     session_cache.remove_for(team_name)
+    if is_signed_mode():
+        signed_sessions.revocation_list.revoke_team(team_name, configuration['session_duration'])
+    shared_state.bump('sessions')
 
 
 def delete_team(team_name):
@@ -272,25 +376,36 @@ def delete_team(team_name):
         'DELETING team {}',
         team_name,
     )
-    with closing(sqlite3.connect(configuration['db_path'])) as db:
+    with database.connect() as db:
         cur = db.cursor()
         cur.execute('DELETE FROM sessions WHERE username = ?', (team_name,))
         cur.execute('DELETE FROM users WHERE username = ?', (team_name,))
         cur.execute('DELETE FROM submissions WHERE team_name = ?', (team_name,))
         cur.execute('DELETE FROM hint_purchases WHERE team_name = ?', (team_name,))
+        cur.execute('DELETE FROM team_points WHERE team_name = ?', (team_name,))
         db.commit()
     session_cache.remove_for(team_name)
+    if is_signed_mode():
+        signed_sessions.revocation_list.revoke_team(team_name, configuration['session_duration'])
+    scoreboard.remove_team(team_name)
+    task_gen.token_cache.invalidate_team(team_name)
+    shared_state.bump('sessions')
+    shared_state.bump('scoreboard', key=team_name)
 
 
 def set_admin(username, value):
     session_cache.maybe_set_admin(username, value)
-    with closing(sqlite3.connect(configuration['db_path'])) as db:
+    with database.connect() as db:
         cur = db.cursor()
         cur.execute('UPDATE users SET is_admin = ? WHERE username = ?', (value, username))
         db.commit()
+    if is_signed_mode():
+        # Signed tokens carry the admin flag, so the team has to log in again to get the new one
+        signed_sessions.revocation_list.revoke_team(username, configuration['session_duration'])
+    shared_state.bump('sessions')
 
 
-def api_change_password(api, sess, args):
+async def api_change_password(api, sess, args):
     http = args['http_handler']
     request = json.loads(http.request.body)
     team_name = request['team_name']
@@ -312,37 +427,38 @@ def api_change_password(api, sess, args):
             )
         )
 
+    # Both run a key derivation function, keep them off the IOLoop
     if sess.is_admin:
-        update_password(team_name, new_password)
+        await hashing.run_in_pool(update_password, team_name, new_password)
         http.write(json.dumps({'success': True}))
         return
-    elif team_name == sess.username and verify_password(team_name, old_password):
-        update_password(team_name, new_password)
+    elif team_name == sess.username and await hashing.run_in_pool(verify_password, team_name, old_password):
+        await hashing.run_in_pool(update_password, team_name, new_password)
         http.write(json.dumps({'success': True}))
         return
     else:
         raise Exception(lc.get('api_call_permission_denied'))
 
 
-def api_logout_team(api, sess, args):
+async def api_logout_team(api, sess, args):
     http = args['http_handler']
     request = json.loads(http.request.body)
     team_name = request['team_name']
 
-    logout_team(team_name)
+    await aio.run_in_executor(logout_team, team_name)
     http.write(json.dumps({'success': True}))
 
 
-def api_delete_team(api, sess, args):
+async def api_delete_team(api, sess, args):
     http = args['http_handler']
     request = json.loads(http.request.body)
     team_name = request['team_name']
 
-    delete_team(team_name)
+    await aio.run_in_executor(delete_team, team_name)
     http.write(json.dumps({'success': True}))
 
 
-def api_set_admin(api, sess, args):
+async def api_set_admin(api, sess, args):
     http = args['http_handler']
     request = json.loads(http.request.body)
     team_name = request['team_name']
@@ -356,13 +472,21 @@ def api_set_admin(api, sess, args):
             )
         )
 
-    set_admin(team_name, value)
+    await aio.run_in_executor(set_admin, team_name, value)
     http.write(json.dumps({'success': True}))
 
 
+def api_session_cache_stats(api, sess, args):
+    http = args['http_handler']
+    http.write(json.dumps({'success': True, 'stats': session_cache.get_stats()}))
+
+
 api.add('change_password', api_change_password, access_level=USER)
 api.add('logout_team',     api_logout_team,     access_level=ADMIN)
 api.add('delete_team',     api_delete_team,     access_level=ADMIN)
 api.add('set_admin',       api_set_admin,       access_level=ADMIN)
+api.add('session_cache_stats', api_session_cache_stats, access_level=ADMIN)
 
 session_cache = SessionCache()
+shared_state.watch('sessions', session_cache.clear)
+shared_state.watch('sessions', signed_sessions.revocation_list.reload)
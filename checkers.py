@@ -0,0 +1,116 @@
+import os
+import json
+import atexit
+import signal
+import asyncio
+
+from loguru import logger
+
+from configuration import configuration
+
+
+# Flag checkers of type 'program' run outside of the main loop as child processes.
+#
+# A regular checker is started for every submission. It gets the task ID, the flag, the token and the
+# team name on separate lines of its stdin, and accepts the flag by exiting with code 0.
+#
+# A checker with "daemon": true in its flag checker entry is started once and then kept running.
+# It gets one JSON object per line on its stdin ({"task_id": ..., "flag": ..., "token": ..., "team_name": ...})
+# and must answer each one with a line containing 1 (correct) or 0 (incorrect). It should exit when
+# its stdin is closed
+
+
+class CheckerError(Exception):
+    pass
+
+
+def kill_process(proc):
+    # Checkers run in their own process group, so whatever they spawned goes away too
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+class CheckerDaemon:
+    def __init__(self, command):
+        self.command = command
+        self.proc = None
+        self.lock = asyncio.Lock()
+
+    async def start(self):
+        logger.info('Starting checker daemon {}', self.command)
+        self.proc = await asyncio.create_subprocess_exec(
+            self.command,
+            stdin             = asyncio.subprocess.PIPE,
+            stdout            = asyncio.subprocess.PIPE,
+            start_new_session = True,
+        )
+
+    def stop(self):
+        if self.proc is not None and self.proc.returncode is None:
+            kill_process(self.proc)
+        self.proc = None
+
+    async def request(self, message, timeout):
+        async with self.lock:
+            if self.proc is None or self.proc.returncode is not None:
+                await self.start()
+            try:
+                self.proc.stdin.write(json.dumps(message).encode() + b'\n')
+                await asyncio.wait_for(self.proc.stdin.drain(), timeout)
+                answer = await asyncio.wait_for(self.proc.stdout.readline(), timeout)
+            except (asyncio.TimeoutError, ConnectionError) as e:
+                # The daemon is hung or dead, a new one is started for the next request
+                self.stop()
+                raise CheckerError('Checker daemon {} failed: {}'.format(self.command, repr(e)))
+            answer = answer.strip()
+            if answer not in {b'0', b'1'}:
+                self.stop()
+                raise CheckerError('Checker daemon {} answered {}'.format(self.command, repr(answer)))
+            return answer == b'1'
+
+
+class CheckerPool:
+    def __init__(self):
+        self.semaphore = asyncio.Semaphore(configuration['checker_concurrency'])
+        self.daemons = {}
+
+    async def run_once(self, command, stdin, timeout):
+        proc = await asyncio.create_subprocess_exec(
+            command,
+            stdin             = asyncio.subprocess.PIPE,
+            start_new_session = True,
+        )
+        try:
+            await asyncio.wait_for(proc.communicate(stdin.encode()), timeout)
+        except asyncio.TimeoutError:
+            logger.warning('Checker {} timed out after {} seconds, killing it', command, timeout)
+            kill_process(proc)
+            await proc.wait()
+            raise CheckerError('Checker {} timed out'.format(command))
+        return proc.returncode == 0
+
+    async def check(self, command, daemon, timeout, task_id, flag, token, team_name):
+        if timeout is None:
+            timeout = configuration['checker_timeout']
+        async with self.semaphore:
+            if daemon:
+                if command not in self.daemons:
+                    self.daemons[command] = CheckerDaemon(command)
+                return await self.daemons[command].request({
+                    'task_id':   task_id,
+                    'flag':      flag,
+                    'token':     token,
+                    'team_name': team_name,
+                }, timeout)
+            return await self.run_once(command, '\n'.join([str(task_id), flag, token, team_name]), timeout)
+
+    def stop_daemons(self):
+        for daemon in self.daemons.values():
+            daemon.stop()
+        self.daemons = {}
+
+
+checker_pool = CheckerPool()
+atexit.register(checker_pool.stop_daemons)
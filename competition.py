@@ -4,7 +4,9 @@ import time
 
 from loguru import logger
 
+import aio
 import util
+from shared_state import shared_state
 from api import api, ADMIN
 from configuration import configuration
 
@@ -57,7 +59,7 @@ def write_competition_config(config):
         f.write(json.dumps(config))
 
 
-def api_competition_ctl(api, sess, args):
+async def api_competition_ctl(api, sess, args):
     http       = args['http_handler']
     request    = json.loads(http.request.body)
     start_time = request['start_time']
@@ -106,12 +108,20 @@ def api_competition_ctl(api, sess, args):
     competition.start_time = start_time
     competition.end_time = end_time
     competition.allow_team_self_registration = allow_team_self_registration
-    write_competition_config(competition.to_dict())
+    await aio.run_in_executor(write_competition_config, competition.to_dict())
+    await aio.run_in_executor(shared_state.bump, 'competition')
 
     http.write(json.dumps({'success': True}))
 
 
+def reload_competition_config():
+    config = read_competition_config()
+    competition.start_time = config['start_time']
+    competition.end_time = config['end_time']
+    competition.allow_team_self_registration = config['allow_team_self_registration']
+
 
 competition = Competition(**read_competition_config())
+shared_state.watch('competition', reload_competition_config)
 
 api.add('competition_ctl', api_competition_ctl, access_level=ADMIN)
@@ -15,15 +15,63 @@ configuration = {
     # Path to the main database
     'db_path':                 'db/ctfhost.db',
 
+    # SQLite journal mode. WAL lets readers work concurrently with a writer and avoids
+    # an fsync of the rollback journal on every commit
+    'db_journal_mode':         'WAL',
+
+    # SQLite synchronous level. NORMAL is safe with WAL (only the last commits may be lost on power failure)
+    'db_synchronous':          'NORMAL',
+
+    # SQLite page cache size per connection. Negative values are in KiB, positive ones are in pages
+    'db_cache_size':           -16384,
+
+    # Maximum size of the memory-mapped part of the database file, in bytes (0 disables mmap)
+    'db_mmap_size':            256 * 1024 * 1024,
+
+    # Number of prepared statements cached per database connection
+    'db_cached_statements':    256,
+
+    # How long to wait for a locked database, in seconds
+    'db_busy_timeout':         10.0,
+
     # Session duration, in seconds
     'session_duration':        86400,
 
+    # 'database' keeps sessions in the database. 'signed' gives out HMAC-signed tokens that are checked
+    # without the database, logged out tokens are kept in a revocation list until they expire
+    'session_mode':            'database',
+
+    # Maximum number of sessions kept in memory (per worker process)
+    'session_cache_size':      100000,
+
+    # How often expired sessions are removed from memory, in seconds
+    'session_sweep_interval':  300,
+
     # If True, passwords will be replaced with <hidden> in logs (recommended)
     'hide_password_in_logs':   True,
 
     # Path to tasks directory
     'tasks_path':              'db/tasks',
 
+    # How often to check the tasks and groups directories for changes made outside of the admin panel, in seconds
+    'catalog_check_interval':  2,
+
+    # How long before the competition start to begin generating task instances for all teams, in seconds.
+    # Set to 0 to generate instances only when teams open them
+    'prewarm_lead_time':       15 * 60,
+
+    # How often the pre-warmer rescans all teams and tasks for missing or outdated instances, in seconds
+    'prewarm_rescan_interval': 60,
+
+    # How often the pre-warmer saves its progress for the status API while generating instances, in seconds
+    'prewarm_status_interval': 1,
+
+    # Maximum number of rendered task texts kept in memory
+    'markdown_cache_size':     4096,
+
+    # Maximum number of compiled flag matchers of generated task instances kept in memory
+    'flag_matcher_cache_size': 65536,
+
     # Path to groups directory
     'groups_path':             'db/groups',
 
@@ -38,10 +86,36 @@ configuration = {
     # Path to group max_id file
     'group_maxid_path':        'db/tasks-etc/maxgroupid.txt',
 
+    # Directory of the lock files that keep processes from generating the same task instance at once
+    'generation_locks_path':   'db/tasks-etc/generation-locks',
+
     # Minimal flag submission interval. Teams won't be able to submit flags more often
-    # than one in min_submission_interval seconds
+    # than one in min_submission_interval seconds on average
     'min_submission_interval': 30,
 
+    # Number of flags a team can submit in a row before min_submission_interval applies
+    'submission_burst':        1,
+
+    # Minimal flag submission interval for a single task, in seconds (0 disables this limit)
+    'min_task_submission_interval': 0,
+
+    # Number of flags a team can submit for a single task in a row before min_task_submission_interval applies
+    'task_submission_burst':   1,
+
+    # Where the submission rate limits are kept: 'database' (shared by worker processes and kept
+    # across restarts) or 'memory' (per process)
+    'rate_limit_backend':      'database',
+
+    # How often rate limit entries of idle teams are removed, in seconds
+    'rate_limit_sweep_interval': 60,
+
+    # Maximum number of flag checking programs running at the same time (per worker process)
+    'checker_concurrency':     8,
+
+    # Time limit for a flag checking program, in seconds. Can be overridden with "timeout" in a flag checker.
+    # Programs that take longer are killed and the flag is considered incorrect
+    'checker_timeout':         10,
+
     # Function to format date in the admin panel (taking a datetime object, returning a str)
     'date_fmt_func':           date_fmt.default_date_fmt,
 
@@ -54,11 +128,28 @@ configuration = {
     # Path to competition configuration file
     'competition_config_path': 'db/competition-ctl/competition-ctl.json',
     
-    # Hash function used to hash passwords and session IDs
+    # Hash function used to hash session IDs (and passwords created by older versions of CTFHost)
     # Change to util.make_hash_function(hashlib.sha256) or something like that if sha3 functions are not available
-    # WARNING: if you change this function, all sessions and passwords in the database will become invalid!
+    # WARNING: if you change this function, all sessions and old passwords in the database will become invalid!
     'secure_hash_function':    util.make_hash_function(hashlib.sha3_256),
 
+    # Key derivation function used to hash passwords: 'scrypt' or 'pbkdf2_sha256'.
+    # Passwords hashed with another function or other parameters are rehashed on the next login
+    'password_kdf':            'scrypt',
+
+    # Parameters of the password key derivation functions
+    'password_kdf_params':     {
+        'scrypt':        {'n': 2 ** 14, 'r': 8, 'p': 1},
+        'pbkdf2_sha256': {'iterations': 600000},
+    },
+
+    # Number of threads used to hash and verify passwords outside of the main loop
+    'password_hash_workers':   4,
+
+    # Number of threads used for database queries, file reads, task generation and flag checking
+    # outside of the main loop
+    'io_workers':              16,
+
     # Path to global hash salt file
     'global_salt_path':        'db/salt.txt',
 
@@ -68,6 +159,18 @@ configuration = {
     # Address to bind to
     'host':                    '0.0.0.0',
 
+    # Number of worker processes serving requests, can be overridden with --workers.
+    # Debug mode supports only one
+    'workers':                 1,
+
+    # How often a worker process checks whether another process changed sessions, the scoreboard,
+    # tasks or the competition configuration, in seconds. With several workers every request checks it too
+    'shared_state_poll_interval': 1,
+
+    # How many recent changes of each kind of shared state are remembered in detail, so that other
+    # worker processes can update just what changed. Processes lagging further behind reload everything
+    'shared_state_change_log_size': 1000,
+
     # Debug mode
     'debug':                   False,
 }
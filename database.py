@@ -0,0 +1,54 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from loguru import logger
+
+from configuration import configuration
+
+
+_local = threading.local()
+
+
+def open_connection():
+    db = sqlite3.connect(
+        configuration['db_path'],
+        detect_types      = sqlite3.PARSE_DECLTYPES,
+        timeout           = configuration['db_busy_timeout'],
+        cached_statements = configuration['db_cached_statements'],
+    )
+    cur = db.cursor()
+    cur.execute('PRAGMA journal_mode = {}'.format(configuration['db_journal_mode']))
+    cur.execute('PRAGMA synchronous = {}'.format(configuration['db_synchronous']))
+    cur.execute('PRAGMA cache_size = {}'.format(int(configuration['db_cache_size'])))
+    cur.execute('PRAGMA mmap_size = {}'.format(int(configuration['db_mmap_size'])))
+    cur.close()
+    logger.debug('Opened database connection for thread {}', threading.current_thread().name)
+    return db
+
+
+def get_connection():
+    # Connections are never shared between threads or inherited by forked processes
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.db = open_connection()
+        _local.pid = os.getpid()
+    return _local.db
+
+
+def close_connection():
+    if getattr(_local, 'pid', None) == os.getpid():
+        _local.db.close()
+    _local.db = None
+    _local.pid = None
+
+
+@contextmanager
+def connect():
+    db = get_connection()
+    try:
+        yield db
+    except BaseException:
+        # The connection outlives this block, so do not leave a half-done transaction on it
+        db.rollback()
+        raise
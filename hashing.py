@@ -0,0 +1,89 @@
+import hashlib
+import hmac
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+
+import tornado.ioloop
+
+from configuration import configuration
+
+
+# Password hashes are stored as $<kdf>$<param>=<value>,...$<salt>$<digest> (salt and digest in hex).
+# Hashes without the leading $ come from older versions and use configuration['secure_hash_function']
+KDFS = {
+    'scrypt': lambda password, salt, params: hashlib.scrypt(
+        password,
+        salt   = salt,
+        n      = params['n'],
+        r      = params['r'],
+        p      = params['p'],
+        maxmem = 256 * params['n'] * params['r'] * params['p'],
+        dklen  = 32,
+    ),
+    'pbkdf2_sha256': lambda password, salt, params: hashlib.pbkdf2_hmac(
+        'sha256',
+        password,
+        salt,
+        params['iterations'],
+    ),
+}
+
+# hashlib releases the GIL while running these KDFs, so threads are enough to keep them off the IOLoop
+executor = ThreadPoolExecutor(max_workers=configuration['password_hash_workers'])
+
+
+class UnknownKdfError(Exception):
+    pass
+
+
+def get_current_kdf():
+    kdf = configuration['password_kdf']
+    if kdf not in KDFS:
+        raise UnknownKdfError(kdf)
+    return kdf, configuration['password_kdf_params'][kdf]
+
+
+def format_params(params):
+    return ','.join('{}={}'.format(k, v) for k, v in sorted(params.items()))
+
+
+def parse_params(params_str):
+    params = {}
+    for item in params_str.split(','):
+        k, v = item.split('=')
+        params[k] = int(v)
+    return params
+
+
+def hash_password(password):
+    kdf, params = get_current_kdf()
+    salt = secrets.token_bytes(16)
+    digest = KDFS[kdf](password.encode(), salt, params)
+    return '${}${}${}${}'.format(kdf, format_params(params), salt.hex(), digest.hex())
+
+
+def hash_password_legacy(password):
+    return configuration['secure_hash_function'](password.encode()).hexdigest()
+
+
+def verify_password(password, password_hash):
+    if not password_hash.startswith('$'):
+        return hmac.compare_digest(hash_password_legacy(password), password_hash)
+    _, kdf, params_str, salt, digest = password_hash.split('$')
+    if kdf not in KDFS:
+        raise UnknownKdfError(kdf)
+    actual_digest = KDFS[kdf](password.encode(), bytes.fromhex(salt), parse_params(params_str))
+    return hmac.compare_digest(actual_digest.hex(), digest)
+
+
+def needs_rehash(password_hash):
+    if not password_hash.startswith('$'):
+        return True
+    kdf, params = get_current_kdf()
+    _, stored_kdf, params_str, _, _ = password_hash.split('$')
+    return stored_kdf != kdf or parse_params(params_str) != params
+
+
+def run_in_pool(func, *args, **kwargs):
+    # Returns an awaitable, must be called from the IOLoop thread
+    return tornado.ioloop.IOLoop.current().run_in_executor(executor, lambda: func(*args, **kwargs))
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 import os
+import json
+import hashlib
 from configparser import ConfigParser
 
 
@@ -8,6 +10,9 @@ class Localization:
     def __init__(self):
         self.languages = {}
         self.selected_languages = []
+        self.messages = {}
+        self.script = ''
+        self.version = ''
 
         for lang_file in os.scandir('locale'):
             if not lang_file.is_file() or not lang_file.name.endswith('.lang'):
@@ -30,20 +35,29 @@ class Localization:
 
     def select_languages(self, langs):
         self.selected_languages = langs
+        # Strings missing in a language fall back to the next selected one
+        messages = {}
+        for lang in self.selected_languages:
+            if lang in self.languages:
+                for k, v in self.languages[lang]['data'].items():
+                    if k not in messages:
+                        messages[k] = v
+        self.messages = messages
+        self.script = 'const locale_messages = {};\n'.format(json.dumps(messages, ensure_ascii=False, sort_keys=True))
+        self.version = hashlib.sha256(self.script.encode()).hexdigest()[:16]
 
     def get(self, key):
-        for lang in self.selected_languages:
-            if lang in self.languages and key in self.languages[lang]['data']:
-                return self.languages[lang]['data'][key]
-        return key
+        return self.messages.get(key, key)
 
     def get_dict(self):
-        result = {}
-        for lang in self.selected_languages:
-            if lang in self.languages:
-                for k, v in self.languages[lang]['data'].items():
-                    if k not in result:
-                        result[k] = v
-        return result
+        # Shared by all callers, must not be modified
+        return self.messages
+
+    def get_script(self):
+        return self.script
+
+    def get_script_url(self):
+        # The version changes with the messages, so the script can be cached forever
+        return '/static/locale/messages-{}.js'.format(self.version)
 
 lc = Localization()
@@ -1,4 +1,126 @@
-from threading import Lock, RLock
+import os
+from contextlib import contextmanager
+from threading import Lock, Condition, get_ident
+from weakref import WeakValueDictionary
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-global_lock = RLock()
+from configuration import configuration
+
+
+class RWLock:
+    # Any number of readers or a single writer. Both sides are reentrant, and the writer may
+    # also take the read side, but a reader can't upgrade to a writer. Waiting writers
+    # block new readers, so a steady stream of reads can't starve them
+    def __init__(self):
+        self.cond = Condition(Lock())
+        self.readers = {}
+        self.writer = None
+        self.writer_depth = 0
+        self.waiting_writers = 0
+
+    def acquire_read(self):
+        me = get_ident()
+        with self.cond:
+            if self.writer != me and me not in self.readers:
+                while self.writer is not None or self.waiting_writers > 0:
+                    self.cond.wait()
+            self.readers[me] = self.readers.get(me, 0) + 1
+
+    def release_read(self):
+        me = get_ident()
+        with self.cond:
+            self.readers[me] -= 1
+            if self.readers[me] == 0:
+                del self.readers[me]
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        me = get_ident()
+        with self.cond:
+            if self.writer == me:
+                self.writer_depth += 1
+                return
+            if me in self.readers:
+                raise RuntimeError('Cannot upgrade a read lock to a write lock')
+            self.waiting_writers += 1
+            while self.writer is not None or len(self.readers) > 0:
+                self.cond.wait()
+            self.waiting_writers -= 1
+            self.writer = me
+            self.writer_depth = 1
+
+    def release_write(self):
+        with self.cond:
+            self.writer_depth -= 1
+            if self.writer_depth == 0:
+                self.writer = None
+                self.cond.notify_all()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+class KeyedLocks:
+    # One lock per key, created on first use and dropped once nobody holds or waits for it
+    def __init__(self):
+        self.lock = Lock()
+        self.locks = WeakValueDictionary()
+
+    def get(self, key):
+        with self.lock:
+            lock = self.locks.get(key)
+            if lock is None:
+                lock = Lock()
+                self.locks[key] = lock
+            return lock
+
+
+# Taken for writing by anything that changes tasks, groups or generation configs on disk
+# and for reading by anything that reads generated task instances
+catalog_lock = RWLock()
+
+# Serialize check-then-act sequences (solving a task, buying a hint) of a team
+team_locks = KeyedLocks()
+
+# Make sure that an instance is generated by one thread at a time
+generation_locks = KeyedLocks()
+
+
+@contextmanager
+def file_lock(path):
+    # Excludes other processes too (worker processes, generate_in_advance.py). The lock is
+    # released when the file is closed, so a crashed process never leaves it taken
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+def team_lock(team_name):
+    return team_locks.get(team_name)
+
+
+@contextmanager
+def generation_lock(task_id, token):
+    # Threads of this process queue on the in-memory lock, so each process waits on the file with one thread at most
+    with generation_locks.get((task_id, token)):
+        with file_lock(os.path.join(configuration['generation_locks_path'], str(task_id), '{}.lock'.format(token))):
+            yield
@@ -0,0 +1,180 @@
+import json
+import time
+from collections import deque
+from threading import Thread, Lock, Event
+
+from loguru import logger
+
+import aio
+import auth
+import database
+import tasks
+import team
+import task_gen
+import util
+from competition import competition
+from configuration import configuration
+from shared_state import shared_state
+from api import api, ADMIN
+
+
+class Prewarmer:
+    # Generates task instances in the background shortly before the competition starts,
+    # so that teams opening /tasks at the start don't have to wait for the generators.
+    # After a full scan, only instances of new teams and updated tasks are generated
+    def __init__(self):
+        self.lock = Lock()
+        self.wakeup = Event()
+        self.thread = None
+        self.pending = deque()
+        self.pending_set = set()
+        self.failed = {}
+        self.generated = 0
+        self.last_scan = None
+        self.published_at = 0
+
+    def start(self):
+        if configuration['prewarm_lead_time'] <= 0:
+            logger.info('Task instance pre-warming is disabled')
+            return
+        self.thread = Thread(target=self.run, name='prewarm', daemon=True)
+        self.thread.start()
+
+    def is_active(self):
+        now = util.get_current_utc_time()
+        return competition.start_time - configuration['prewarm_lead_time'] <= now < competition.end_time
+
+    def enqueue(self, task_id, team_name):
+        with self.lock:
+            if (task_id, team_name) in self.pending_set:
+                return
+            self.pending_set.add((task_id, team_name))
+            self.pending.append((task_id, team_name))
+
+    def notify_team(self, team_name):
+        if self.thread is None:
+            return
+        for task in tasks.get_task_list():
+            self.enqueue(task.task_id, team_name)
+        self.wakeup.set()
+
+    def notify_task(self, task_id):
+        if self.thread is None:
+            return
+        for tm in team.get_all_teams():
+            self.enqueue(task_id, tm.team_name)
+        self.wakeup.set()
+
+    def request_scan(self):
+        if self.thread is None:
+            return
+        self.last_scan = None
+        self.wakeup.set()
+
+    def on_catalog_change(self, task_ids):
+        # Tasks changed by other worker processes. A change that names no task (e.g. a group) may affect any
+        if task_ids is None:
+            self.request_scan()
+            return
+        for task_id in task_ids:
+            self.notify_task(int(task_id))
+
+    def on_registration(self, team_names):
+        # Teams registered through other worker processes
+        if team_names is None:
+            self.request_scan()
+            return
+        for team_name in team_names:
+            self.notify_team(team_name)
+
+    def scan(self):
+        task_list = list(tasks.get_task_list())
+        for tm in team.get_all_teams():
+            for task in task_list:
+                token = task_gen.get_token(team_name=tm.team_name, task_id=task.task_id)
+                input_hash = task_gen.get_input_hash(task.task_id, token)
+                if not task_gen.generation_manifest.is_up_to_date(task.task_id, token, input_hash):
+                    self.enqueue(task.task_id, tm.team_name)
+        self.last_scan = time.time()
+        logger.info('Pre-warm scan finished, {} task instances pending', len(self.pending))
+
+    def generate_one(self):
+        with self.lock:
+            if len(self.pending) == 0:
+                return False
+            task_id, team_name = self.pending[0]
+        try:
+            token = task_gen.get_token(team_name=team_name, task_id=task_id)
+            task_gen.maybe_generate(task_id, token, team.read_team(team_name))
+            self.failed.pop((task_id, team_name), None)
+            self.generated += 1
+        except (tasks.TaskNotFoundError, auth.TeamNotFoundError):
+            # Deleted after being queued
+            pass
+        except Exception as e:
+            logger.error('Pre-warming task {} for team {} failed: {}', task_id, team_name, repr(e))
+            self.failed[(task_id, team_name)] = repr(e)
+        finally:
+            # Whatever happened, the item must not block the queue
+            with self.lock:
+                self.pending.popleft()
+                self.pending_set.discard((task_id, team_name))
+        return True
+
+    def publish_status(self):
+        # Only the first worker process runs the pre-warmer, so its progress goes to the database
+        # where the status API of every worker can read it
+        with self.lock:
+            status = (len(self.pending), self.generated, len(self.failed), self.last_scan, time.time())
+        with database.connect() as db:
+            cur = db.cursor()
+            cur.execute('INSERT OR REPLACE INTO prewarm_status VALUES (0, ?, ?, ?, ?, ?)', status)
+            db.commit()
+        self.published_at = status[-1]
+
+    def run(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                if self.is_active():
+                    if self.last_scan is None or time.time() - self.last_scan >= configuration['prewarm_rescan_interval']:
+                        self.scan()
+                    while self.generate_one():
+                        if time.time() - self.published_at >= configuration['prewarm_status_interval']:
+                            self.publish_status()
+                self.publish_status()
+            except Exception as e:
+                logger.error('Pre-warm scan failed: {}', repr(e))
+            self.wakeup.wait(timeout=configuration['prewarm_rescan_interval'])
+
+    def get_status(self):
+        with database.connect() as db:
+            cur = db.cursor()
+            cur.execute('SELECT pending, generated, failed, last_scan, updated_at FROM prewarm_status')
+            row = cur.fetchone()
+        if row is None:
+            # Not started since the database was created
+            row = (0, 0, 0, None, None)
+        pending, generated, failed, last_scan, updated_at = row
+        return {
+            'active':     configuration['prewarm_lead_time'] > 0 and self.is_active(),
+            'pending':    pending,
+            'generated':  generated,
+            'failed':     failed,
+            'last_scan':  None if last_scan is None else int(last_scan),
+            'updated_at': None if updated_at is None else int(updated_at),
+        }
+
+
+prewarmer = Prewarmer()
+shared_state.watch('catalog', prewarmer.on_catalog_change, keyed=True)
+shared_state.watch('registrations', prewarmer.on_registration, keyed=True)
+
+
+async def api_prewarm_status(api, sess, args):
+    http = args['http_handler']
+    status = await aio.run_in_executor(prewarmer.get_status)
+    http.write(json.dumps({'success': True, 'status': status}))
+
+
+api.add('prewarm_status', api_prewarm_status, access_level=ADMIN)
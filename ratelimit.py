@@ -0,0 +1,136 @@
+import time
+from threading import Lock
+
+from loguru import logger
+
+import database
+from configuration import configuration
+
+
+class Limit:
+    # Token bucket: up to `burst` events at once, refilled with one token every `interval` seconds
+    def __init__(self, key, burst, interval):
+        self.key = key
+        self.burst = burst
+        self.interval = interval
+
+    def refill(self, tokens, elapsed):
+        return min(self.burst, tokens + elapsed / self.interval)
+
+    def full_at(self, tokens, now):
+        # After this moment the bucket is full again and may be forgotten
+        return now + (self.burst - tokens) * self.interval
+
+
+class MemoryBackend:
+    # Buckets of this process only. Limits are lost on restart and not shared between workers
+    def __init__(self):
+        self.lock = Lock()
+        self.buckets = {}
+
+    def acquire(self, limits, now):
+        with self.lock:
+            new_tokens = []
+            for limit in limits:
+                tokens, updated, _ = self.buckets.get(limit.key, (limit.burst, now, now))
+                tokens = limit.refill(tokens, now - updated)
+                if tokens < 1:
+                    return limit
+                new_tokens.append((limit, tokens - 1))
+            for limit, tokens in new_tokens:
+                self.buckets[limit.key] = (tokens, now, limit.full_at(tokens, now))
+            return None
+
+    def evict_idle(self, now):
+        with self.lock:
+            idle = [key for key, (_, _, full_at) in self.buckets.items() if full_at <= now]
+            for key in idle:
+                del self.buckets[key]
+            return len(idle)
+
+
+class DatabaseBackend:
+    # Buckets in the database: shared by all worker processes and kept across restarts.
+    # Each bucket is checked and updated by a single statement, all of them in one transaction
+    def acquire(self, limits, now):
+        with database.connect() as db:
+            cur = db.cursor()
+            for limit in limits:
+                cur.execute(
+                    '''
+                    INSERT INTO rate_limit_buckets (key, tokens, updated, full_at) VALUES (?1, ?2 - 1, ?4, ?4 + ?3)
+                    ON CONFLICT (key) DO UPDATE SET
+                        tokens  = MIN(?2, tokens + (?4 - updated) / ?3) - 1,
+                        updated = ?4,
+                        full_at = ?4 + (?2 - MIN(?2, tokens + (?4 - updated) / ?3) + 1) * ?3
+                    WHERE MIN(?2, tokens + (?4 - updated) / ?3) >= 1
+                    ''',
+                    (limit.key, limit.burst, limit.interval, now)
+                )
+                if cur.rowcount == 0:
+                    db.rollback()
+                    return limit
+            db.commit()
+            return None
+
+    def evict_idle(self, now):
+        with database.connect() as db:
+            cur = db.cursor()
+            cur.execute('DELETE FROM rate_limit_buckets WHERE full_at <= ?', (now,))
+            db.commit()
+            return cur.rowcount
+
+
+BACKENDS = {
+    'memory':   MemoryBackend,
+    'database': DatabaseBackend,
+}
+
+
+class RateLimiter:
+    def __init__(self):
+        self.backend = None
+        self.last_sweep = time.monotonic()
+        self.lock = Lock()
+
+    def get_backend(self):
+        if self.backend is None:
+            self.backend = BACKENDS[configuration['rate_limit_backend']]()
+        return self.backend
+
+    def acquire(self, limits):
+        # Takes a token from every bucket, or from none of them if any one is empty.
+        # Returns the limit of the first empty bucket, or None if the tokens were taken
+        limits = [limit for limit in limits if limit.interval > 0]
+        if len(limits) == 0:
+            return None
+        self.maybe_evict_idle()
+        return self.get_backend().acquire(limits, time.time())
+
+    def maybe_evict_idle(self):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_sweep < configuration['rate_limit_sweep_interval']:
+                return
+            self.last_sweep = now
+        count = self.get_backend().evict_idle(time.time())
+        if count > 0:
+            logger.debug('Evicted {} idle rate limit buckets', count)
+
+
+rate_limiter = RateLimiter()
+
+
+def acquire_submission(team_name, task_id):
+    return rate_limiter.acquire([
+        Limit(
+            'submit:{}'.format(team_name),
+            configuration['submission_burst'],
+            configuration['min_submission_interval'],
+        ),
+        Limit(
+            'submit:{}:{}'.format(team_name, task_id),
+            configuration['task_submission_burst'],
+            configuration['min_task_submission_interval'],
+        ),
+    ])
@@ -0,0 +1,152 @@
+from loguru import logger
+
+import database
+
+
+# Each migration upgrades the schema by one version and is applied exactly once.
+# Never edit a migration that has been released, append a new one instead
+MIGRATIONS = [
+    # Version 1: indexes for per-team lookups and session expiration
+    '''
+    CREATE INDEX IF NOT EXISTS submissions_team_task_correct ON submissions (team_name, task_id, correct);
+    CREATE INDEX IF NOT EXISTS submissions_task ON submissions (task_id);
+    CREATE INDEX IF NOT EXISTS hint_purchases_team ON hint_purchases (team_name);
+    CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires);
+    CREATE INDEX IF NOT EXISTS sessions_username ON sessions (username);
+    ''',
+
+    # Version 2: per-team points ledger, maintained together with submissions and hint purchases
+    '''
+    CREATE TABLE IF NOT EXISTS team_points (
+        team_name       VARCHAR   NOT NULL UNIQUE,
+        earned          INTEGER   NOT NULL DEFAULT 0,
+        spent           INTEGER   NOT NULL DEFAULT 0
+    );
+    INSERT OR IGNORE INTO team_points (team_name, earned, spent)
+    SELECT
+        username,
+        (SELECT COALESCE(SUM(points), 0) FROM submissions WHERE team_name = username),
+        (SELECT COALESCE(SUM(cost), 0) FROM hint_purchases WHERE team_name = username)
+    FROM users;
+    ''',
+
+    # Version 3: manifest of generated task instances and the inputs they were generated from
+    '''
+    CREATE TABLE IF NOT EXISTS generated_tasks (
+        task_id         INTEGER   NOT NULL,
+        token           VARCHAR   NOT NULL,
+        input_hash      VARCHAR   NOT NULL,
+        status          VARCHAR   NOT NULL,
+        generated_at    INTEGER   NOT NULL,
+        UNIQUE (task_id, token)
+    );
+    ''',
+
+    # Version 4: at most one correct submission per team and task and one purchase per hint,
+    # enforced by the database. Duplicates left by earlier races are dropped and the ledger is recomputed
+    '''
+    DELETE FROM submissions WHERE correct = 1 AND rowid NOT IN (
+        SELECT MIN(rowid) FROM submissions WHERE correct = 1 GROUP BY team_name, task_id
+    );
+    DELETE FROM hint_purchases WHERE rowid NOT IN (
+        SELECT MIN(rowid) FROM hint_purchases GROUP BY team_name, task_id, hint_hexid
+    );
+    CREATE UNIQUE INDEX IF NOT EXISTS submissions_one_correct ON submissions (team_name, task_id) WHERE correct = 1;
+    CREATE UNIQUE INDEX IF NOT EXISTS hint_purchases_unique ON hint_purchases (team_name, task_id, hint_hexid);
+    UPDATE team_points SET
+        earned = (SELECT COALESCE(SUM(points), 0) FROM submissions WHERE submissions.team_name = team_points.team_name),
+        spent  = (SELECT COALESCE(SUM(cost), 0) FROM hint_purchases WHERE hint_purchases.team_name = team_points.team_name);
+    ''',
+
+    # Version 5: state shared between worker processes
+    '''
+    CREATE TABLE IF NOT EXISTS shared_state_versions (
+        name            VARCHAR   NOT NULL UNIQUE,
+        version         INTEGER   NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS submission_times (
+        team_name       VARCHAR   NOT NULL UNIQUE,
+        last_time       REAL      NOT NULL
+    );
+    ''',
+
+    # Version 6: token buckets of the rate limiter, replacing the last submission times
+    '''
+    CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+        key             VARCHAR   NOT NULL UNIQUE,
+        tokens          REAL      NOT NULL,
+        updated         REAL      NOT NULL,
+        full_at         REAL      NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS rate_limit_buckets_full_at ON rate_limit_buckets (full_at);
+    DROP TABLE IF EXISTS submission_times;
+    ''',
+
+    # Version 7: revoked tokens of the signed session mode, kept until the tokens expire
+    '''
+    CREATE TABLE IF NOT EXISTS session_revocations (
+        key             VARCHAR   NOT NULL UNIQUE,
+        revoked_at      REAL      NOT NULL,
+        expires         REAL      NOT NULL
+    );
+    ''',
+
+    # Version 8: what changed with each recent shared state version
+    '''
+    CREATE TABLE IF NOT EXISTS shared_state_changes (
+        name            VARCHAR   NOT NULL,
+        version         INTEGER   NOT NULL,
+        key             VARCHAR   NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS shared_state_changes_name_version ON shared_state_changes (name, version);
+    ''',
+
+    # Version 9: progress of the task instance pre-warmer, which runs in one worker process only
+    '''
+    CREATE TABLE IF NOT EXISTS prewarm_status (
+        id              INTEGER   PRIMARY KEY CHECK (id = 0),
+        pending         INTEGER   NOT NULL,
+        generated       INTEGER   NOT NULL,
+        failed          INTEGER   NOT NULL,
+        last_scan       REAL,
+        updated_at      REAL      NOT NULL
+    );
+    ''',
+]
+
+
+def get_schema_version(db):
+    cur = db.cursor()
+    cur.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+    cur.execute('SELECT version FROM schema_version LIMIT 1')
+    row = cur.fetchone()
+    if row is None:
+        cur.execute('INSERT INTO schema_version VALUES (0)')
+        db.commit()
+        return 0
+    return row[0]
+
+
+def get_latest_version():
+    return len(MIGRATIONS)
+
+
+def migrate():
+    with database.connect() as db:
+        version = get_schema_version(db)
+        if version > get_latest_version():
+            raise Exception(
+                'Database schema version {} is newer than this CTFHost supports ({})'.format(
+                    version,
+                    get_latest_version(),
+                )
+            )
+        for new_version in range(version + 1, get_latest_version() + 1):
+            logger.info('Migrating database schema to version {}', new_version)
+            # executescript() does not run inside the implicit transaction, so make it explicit
+            db.executescript(
+                'BEGIN;\n{}\nUPDATE schema_version SET version = {};\nCOMMIT;'.format(
+                    MIGRATIONS[new_version - 1],
+                    new_version,
+                )
+            )
@@ -0,0 +1,101 @@
+import bisect
+from threading import RLock
+
+from loguru import logger
+
+
+class ScoreboardEntry:
+    def __init__(self, team_name, full_name, points, solves, order):
+        self.team_name = team_name
+        self.full_name = full_name
+        self.points    = points
+        self.solves    = solves
+        self.order     = order
+
+    def sort_key(self):
+        # Teams with equal points keep their registration order
+        return (-self.points, self.order, self.team_name)
+
+
+class Scoreboard:
+    def __init__(self):
+        self.lock = RLock()
+        self.entries = {}
+        self.ranking = []
+        self.next_order = 0
+
+    def load(self, teams):
+        with self.lock:
+            self.entries = {}
+            self.ranking = []
+            self.next_order = 0
+            for tm in teams:
+                self._insert(ScoreboardEntry(tm.team_name, tm.full_name, tm.points, set(tm.solves), self.next_order))
+                self.next_order += 1
+            logger.info('Loaded scoreboard with {} teams', len(self.entries))
+
+    def _insert(self, entry):
+        self.entries[entry.team_name] = entry
+        bisect.insort(self.ranking, (entry.sort_key(), entry))
+
+    def _remove(self, entry):
+        index = bisect.bisect_left(self.ranking, (entry.sort_key(),))
+        del self.ranking[index]
+        del self.entries[entry.team_name]
+
+    def add_team(self, team_name, full_name):
+        with self.lock:
+            if team_name in self.entries:
+                return
+            self._insert(ScoreboardEntry(team_name, full_name, 0, set(), self.next_order))
+            self.next_order += 1
+
+    def remove_team(self, team_name):
+        with self.lock:
+            if team_name in self.entries:
+                self._remove(self.entries[team_name])
+
+    def update_team(self, team_name, full_name, points, solves):
+        # Returns False if the team is not on the scoreboard
+        with self.lock:
+            entry = self.entries.get(team_name)
+            if entry is None:
+                return False
+            self._remove(entry)
+            entry.full_name = full_name
+            entry.points = points
+            entry.solves = set(solves)
+            self._insert(entry)
+            return True
+
+    def rename_team(self, team_name, full_name):
+        with self.lock:
+            if team_name in self.entries:
+                self.entries[team_name].full_name = full_name
+
+    def add_points(self, team_name, delta, solved_task_id=None):
+        with self.lock:
+            entry = self.entries.get(team_name)
+            if entry is None:
+                logger.warning('Team {} is not on the scoreboard', team_name)
+                return
+            self._remove(entry)
+            entry.points += delta
+            if solved_task_id is not None:
+                entry.solves.add(solved_task_id)
+            self._insert(entry)
+
+    def get_rank(self, team_name):
+        with self.lock:
+            entry = self.entries.get(team_name)
+            if entry is None:
+                return None
+            return bisect.bisect_left(self.ranking, (entry.sort_key(),)) + 1
+
+    def get_top(self, count=None):
+        with self.lock:
+            ranking = self.ranking if count is None else self.ranking[:count]
+            return [entry for _, entry in ranking]
+
+
+scoreboard = Scoreboard()
@@ -11,10 +11,11 @@ from secrets import token_hex
 path.insert(0, realpath('.'))
 
 from configuration import configuration
+import hashing
+import schema
 
 
 db_path = configuration['db_path']
-hash_function = configuration['secure_hash_function']
 sql_script_path = 'scripts/bootstrap.sql'
 password_raw_length = 12
 
@@ -50,7 +51,7 @@ def main():
     password_raw = urandom(password_raw_length)
     password = b64encode(password_raw).decode()
     print('Your CTFHost root password is "{}". Keep it private!'.format(password))
-    password_hash = hash_function(password.encode()).hexdigest()
+    password_hash = hashing.hash_password(password)
 
     token_seed = token_hex(16)
     sql = sql.replace('@@_PASSWORD_HASH_@@', password_hash).replace('@@_TOKEN_SEED_@@', token_seed)
@@ -61,6 +62,9 @@ def main():
     cur.executescript(sql)
     db.commit()
     db.close()
+
+    print('Applying schema migrations')
+    schema.migrate()
     print('Done')
 
 if __name__ == '__main__':
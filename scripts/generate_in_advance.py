@@ -2,33 +2,186 @@
 
 import sys
 import os
+import time
+import signal
+import argparse
+import multiprocessing
 
 sys.path.insert(0, os.path.realpath('.'))
 
 from configuration import configuration
 
+import database
+import locks
 import task_gen
 import tasks
 import team
 
 
+class GenerationTimeout(Exception):
+    pass
+
+
+def on_timeout(signum, frame):
+    raise GenerationTimeout()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Generates all tasks for all teams in advance')
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='Regenerate even if generated tasks are up-to-date',
+    )
+    parser.add_argument(
+        '--jobs', '-j',
+        type=int,
+        default=1,
+        help='Number of worker processes (default: 1)',
+    )
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=0,
+        help='Time limit for generating one task instance, in seconds (default: no limit)',
+    )
+    parser.add_argument(
+        '--checkpoint',
+        default=os.path.join(os.path.dirname(configuration['task_maxid_path']), 'generate-in-advance.checkpoint'),
+        help='File to record progress of a --force run in, so that an interrupted run can be resumed',
+    )
+    parser.add_argument(
+        '--report',
+        type=int,
+        default=10,
+        help='Number of slowest tasks to report (default: 10)',
+    )
+    return parser.parse_args()
+
+
+def set_instance_timeout(timeout):
+    global instance_timeout
+    instance_timeout = timeout
+    signal.signal(signal.SIGALRM, on_timeout)
+
+
+def init_worker(timeout):
+    # Ctrl+C is handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    set_instance_timeout(timeout)
+
+
+def force_generate(task_id, token, team):
+    with locks.generation_lock(task_id, token):
+        task_gen.generate(task_id=task_id, token=token, team=team)
+
+
+def generate_instance(job):
+    task_id, token, tm, force = job
+    generate_func = force_generate if force else task_gen.maybe_generate
+    error = None
+    start = time.monotonic()
+    if instance_timeout > 0:
+        signal.setitimer(signal.ITIMER_REAL, instance_timeout)
+    try:
+        generate_func(task_id=task_id, token=token, team=tm)
+    except GenerationTimeout:
+        error = 'timed out'
+    except Exception as e:
+        error = repr(e)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+    return task_id, tm.team_name, token, time.monotonic() - start, error
+
+
+def read_checkpoint(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return set(line.strip() for line in f if line.strip() != '')
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return '{}:{:02}:{:02}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def show_progress(done, total, start):
+    elapsed = time.monotonic() - start
+    eta = elapsed / done * (total - done) if done > 0 else 0
+    print(
+        '\r[{}/{}] elapsed {}, ETA {}'.format(done, total, format_duration(elapsed), format_duration(eta)),
+        end='',
+        file=sys.stderr,
+        flush=True,
+    )
+
+
 def main():
-    if '--help' in sys.argv:
-        print('Usage: {} [--force]'.format(sys.argv[0]))
-        print('Generates all tasks for all teams in advance')
-        print()
-        print('Options:')
-        print('  --force   Regenerate even if generated tasks are up-to-date')
-        sys.exit(1)
-    generate_func = task_gen.generate if '--force' in sys.argv else task_gen.maybe_generate
-    
-    team_list = list(team.get_all_teams())
+    args = parse_args()
+
+    team_list = list(team.get_all_teams(with_submissions=True))
     task_list = list(tasks.get_task_list())
 
+    # A run without --force skips up-to-date instances using the generation manifest,
+    # so it is resumable by itself. A forced run records finished instances in the checkpoint file
+    finished = read_checkpoint(args.checkpoint) if args.force else set()
+    if len(finished) > 0:
+        print('Resuming: {} instances already generated'.format(len(finished)), file=sys.stderr)
+
+    jobs = []
     for tm in team_list:
         for ts in task_list:
             token = task_gen.get_token(team_name=tm.team_name, task_id=ts.task_id)
-            generate_func(task_id=ts.task_id, token=token, team=tm)
+            if '{} {}'.format(ts.task_id, token) not in finished:
+                jobs.append((ts.task_id, token, tm, args.force))
+
+    set_instance_timeout(args.timeout)
+    # SQLite connections must not be used across fork(), the pool processes open their own
+    database.close_connection()
+    pool = multiprocessing.Pool(args.jobs, initializer=init_worker, initargs=(args.timeout,)) if args.jobs > 1 else None
+    results = pool.imap_unordered(generate_instance, jobs) if pool is not None else map(generate_instance, jobs)
+
+    failures = []
+    task_times = {}
+    start = time.monotonic()
+    checkpoint = open(args.checkpoint, 'a') if args.force else None
+    try:
+        show_progress(0, len(jobs), start)
+        for done, (task_id, team_name, token, duration, error) in enumerate(results, start=1):
+            task_times[task_id] = task_times.get(task_id, 0) + duration
+            if error is not None:
+                failures.append((task_id, team_name, error))
+            elif checkpoint is not None:
+                checkpoint.write('{} {}\n'.format(task_id, token))
+                checkpoint.flush()
+            show_progress(done, len(jobs), start)
+    except KeyboardInterrupt:
+        print('\nInterrupted, run again to resume', file=sys.stderr)
+        if pool is not None:
+            pool.terminate()
+        sys.exit(1)
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    print(file=sys.stderr)
+
+    titles = {ts.task_id: ts.title for ts in task_list}
+    print('Generated {} instances in {}'.format(len(jobs) - len(failures), format_duration(time.monotonic() - start)))
+    if len(task_times) > 0:
+        print('Slowest tasks (total generation time):')
+        for task_id, duration in sorted(task_times.items(), key=lambda x: -x[1])[:args.report]:
+            print('  {:8.2f}s  {} ({})'.format(duration, titles[task_id], task_id))
+    if len(failures) > 0:
+        print('Failed instances: {}'.format(len(failures)))
+        for task_id, team_name, error in failures:
+            print('  task {} ({}), team {}: {}'.format(titles[task_id], task_id, team_name, error))
+        sys.exit(1)
+    if args.force and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
 
 
 if __name__ == '__main__':
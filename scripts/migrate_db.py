@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+
+sys.path.insert(0, os.path.realpath('.'))
+
+import database
+import schema
+
+
+def main():
+    if '--help' in sys.argv or '-h' in sys.argv:
+        print('Usage: {prog}'.format(prog=sys.argv[0]))
+        print('Upgrade the database schema to the latest version')
+        sys.exit(0)
+
+    with database.connect() as db:
+        old_version = schema.get_schema_version(db)
+    schema.migrate()
+    print('Schema version: {} -> {}'.format(old_version, schema.get_latest_version()))
+
+
+if __name__ == '__main__':
+    main()
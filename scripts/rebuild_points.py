@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+
+sys.path.insert(0, os.path.realpath('.'))
+
+import schema
+import team
+
+
+def main():
+    if '--help' in sys.argv or '-h' in sys.argv:
+        print('Usage: {prog}'.format(prog=sys.argv[0]))
+        print('Recompute the points of all teams from their submissions and hint purchases')
+        sys.exit(0)
+
+    schema.migrate()
+    team.rebuild_points()
+    print('Done')
+
+
+if __name__ == '__main__':
+    main()
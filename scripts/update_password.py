@@ -9,6 +9,7 @@ from getpass import getpass
 path.insert(0, os.path.realpath('.'))
 
 from configuration import configuration
+import hashing
 
 
 usage_str='''Usage: update_password.py <username>
@@ -36,7 +37,7 @@ if password != password_c:
     print('Password and its confirmation do not match', file=stderr)
     exit(1)
 
-password_hash = configuration['secure_hash_function'](password.encode()).hexdigest()
+password_hash = hashing.hash_password(password)
 
 with closing(sqlite3.connect(configuration['db_path'])) as db:
     cur = db.cursor()
@@ -0,0 +1,101 @@
+from threading import Lock
+
+from loguru import logger
+
+import database
+from configuration import configuration
+
+
+class SharedState:
+    # Every worker process keeps some state in memory (sessions, scoreboard, competition config).
+    # A process that changes such state bumps its version in the database, and all processes
+    # poll the versions and reload whatever another process has changed.
+    # A bump may name what changed (a key, such as a team name). Watchers registered with keyed=True
+    # get the set of changed keys, or None if some change did not name one and everything must be reloaded
+    def __init__(self):
+        self.lock = Lock()
+        self.versions = {}
+        self.watchers = {}
+        # Set by main when there are several worker processes. A single process only needs the
+        # periodic poll, for changes made by scripts
+        self.poll_on_request = False
+
+    def watch(self, name, callback, keyed=False):
+        self.watchers.setdefault(name, []).append((callback, keyed))
+
+    def bump(self, name, key=None):
+        with database.connect() as db:
+            cur = db.cursor()
+            cur.execute(
+                'INSERT INTO shared_state_versions (name, version) VALUES (?, 1) '
+                'ON CONFLICT (name) DO UPDATE SET version = version + 1',
+                (name,)
+            )
+            cur.execute('SELECT version FROM shared_state_versions WHERE name = ?', (name,))
+            version = cur.fetchone()[0]
+            if key is not None:
+                cur.execute(
+                    'INSERT INTO shared_state_changes (name, version, key) VALUES (?, ?, ?)',
+                    (name, version, key)
+                )
+                cur.execute(
+                    'DELETE FROM shared_state_changes WHERE name = ? AND version <= ?',
+                    (name, version - configuration['shared_state_change_log_size'])
+                )
+            db.commit()
+        with self.lock:
+            # This process already has the change. If another process bumped the version meanwhile,
+            # leave it to poll() to reload
+            if self.versions.get(name, 0) == version - 1:
+                self.versions[name] = version
+
+    def get_changed_keys(self, name, old_version, new_version):
+        with database.connect() as db:
+            cur = db.cursor()
+            cur.execute(
+                'SELECT version, key FROM shared_state_changes WHERE name = ? AND version > ? AND version <= ?',
+                (name, old_version, new_version)
+            )
+            rows = cur.fetchall()
+        if len(set(version for version, _ in rows)) != new_version - old_version:
+            return None
+        return set(key for _, key in rows)
+
+    def poll(self):
+        with database.connect() as db:
+            cur = db.cursor()
+            cur.execute('SELECT name, version FROM shared_state_versions')
+            versions = dict(cur.fetchall())
+        changed = []
+        with self.lock:
+            for name, version in versions.items():
+                old_version = self.versions.get(name, 0)
+                if old_version != version:
+                    changed.append((name, old_version, version))
+                    self.versions[name] = version
+        for name, old_version, version in changed:
+            logger.debug('Shared state "{}" changed in another process, reloading', name)
+            watchers = self.watchers.get(name, [])
+            keys = None
+            if any(keyed for _, keyed in watchers):
+                keys = self.get_changed_keys(name, old_version, version)
+            for callback, keyed in watchers:
+                try:
+                    if keyed:
+                        callback(keys)
+                    else:
+                        callback()
+                except Exception as e:
+                    logger.error('Error reloading shared state "{}": {}', name, repr(e))
+
+    def sync(self):
+        # Takes the current versions as known without reloading anything. Called before
+        # the state is first loaded, so that changes made after that are not missed
+        with database.connect() as db:
+            cur = db.cursor()
+            cur.execute('SELECT name, version FROM shared_state_versions')
+            with self.lock:
+                self.versions = dict(cur.fetchall())
+
+
+shared_state = SharedState()
@@ -0,0 +1,141 @@
+import hmac
+import json
+import time
+import base64
+import hashlib
+import secrets
+from threading import Lock
+
+from loguru import logger
+
+import database
+import util
+
+
+# Session tokens of the 'signed' session mode: <payload>.<signature>, both base64url-encoded.
+# The payload holds the username, the admin flag, the issue and expiration times and a random
+# nonce. Tokens are checked with the key alone, the database is only written when one is revoked
+
+def get_key():
+    # Derived from the global salt, so no other secret has to be kept
+    return hmac.new(util.read_global_salt(), b'session tokens', hashlib.sha256).digest()
+
+
+def encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def sign(payload):
+    return encode(hmac.new(get_key(), payload.encode(), hashlib.sha256).digest())
+
+
+def issue_token(username, is_admin, expires_at):
+    payload = encode(json.dumps({
+        'u': username,
+        'a': is_admin,
+        'i': time.time(),
+        'e': expires_at,
+        'n': secrets.token_hex(16),
+    }).encode())
+    return '{}.{}'.format(payload, sign(payload))
+
+
+def parse_token(token):
+    # Returns the payload of a token with a valid signature, or None
+    try:
+        payload, signature = token.split('.')
+        if not hmac.compare_digest(sign(payload), signature):
+            return None
+        return json.loads(decode(payload))
+    except (ValueError, TypeError):
+        return None
+
+
+def verify_token(token):
+    # Returns the payload of a valid, unexpired and not revoked token, or None
+    payload = parse_token(token)
+    if payload is None or payload['e'] <= time.time():
+        return None
+    if revocation_list.is_revoked(payload):
+        return None
+    return payload
+
+
+class RevocationList:
+    # Signed tokens cannot be deleted, so logged out tokens ('token:<nonce>') and teams whose tokens
+    # issued until some moment are void ('team:<username>') are listed here until those tokens expire.
+    # The list is kept in the database and reloaded when another process bumps the 'sessions' state
+    def __init__(self):
+        self.lock = Lock()
+        self.tokens = {}
+        self.teams = {}
+        self.loaded = False
+
+    def load(self):
+        with database.connect() as db:
+            cur = db.cursor()
+            cur.execute('SELECT key, revoked_at, expires FROM session_revocations')
+            rows = cur.fetchall()
+        tokens = {}
+        teams = {}
+        for key, revoked_at, expires in rows:
+            kind, name = key.split(':', 1)
+            if kind == 'token':
+                tokens[name] = expires
+            elif kind == 'team':
+                teams[name] = (revoked_at, expires)
+        with self.lock:
+            self.tokens = tokens
+            self.teams = teams
+            self.loaded = True
+        logger.debug('Loaded {} revoked session tokens and {} revoked teams', len(tokens), len(teams))
+
+    def reload(self):
+        if self.loaded:
+            self.load()
+
+    def add(self, key, revoked_at, expires):
+        with database.connect() as db:
+            cur = db.cursor()
+            cur.execute('DELETE FROM session_revocations WHERE expires <= ?', (time.time(),))
+            cur.execute(
+                'INSERT INTO session_revocations (key, revoked_at, expires) VALUES (?, ?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET revoked_at = excluded.revoked_at, '
+                'expires = MAX(expires, excluded.expires)',
+                (key, revoked_at, expires)
+            )
+            db.commit()
+        self.load()
+
+    def revoke_token(self, token):
+        payload = parse_token(token)
+        if payload is not None:
+            self.add('token:{}'.format(payload['n']), time.time(), payload['e'])
+
+    def revoke_team(self, username, session_duration):
+        # Any token of the team issued until now expires within session_duration
+        now = time.time()
+        self.add('team:{}'.format(username), now, now + session_duration)
+
+    def is_revoked(self, payload):
+        if not self.loaded:
+            self.load()
+        with self.lock:
+            if payload['n'] in self.tokens:
+                return True
+            team = self.teams.get(payload['u'])
+            return team is not None and payload['i'] <= team[0]
+
+    def prune(self):
+        # Drops expired entries from memory, they are deleted from the database on the next revocation
+        with self.lock:
+            now = time.time()
+            self.tokens = {k: v for k, v in self.tokens.items() if v > now}
+            self.teams = {k: v for k, v in self.teams.items() if v[1] > now}
+
+
+revocation_list = RevocationList()
@@ -4,59 +4,207 @@ import hashlib
 import traceback
 import json
 import time
+import types
+from threading import Lock, RLock
+from collections import OrderedDict
 
 from loguru import logger
 
+import aio
+import database
+import locks
 import tasks
 import util
 import team
 from configuration import configuration
 from api import api, ADMIN, USER, GUEST, ApiArgumentError
+from localization import lc
+from shared_state import shared_state
 
 
 class PresetNotFoundError(Exception):
     pass
 
 
+class TokenCache:
+    # Tokens only depend on the team seed, the (possibly inherited) task seed and the global seed,
+    # so cached tokens are dropped only when one of those changes
+    def __init__(self):
+        self.lock = Lock()
+        self.tokens = {}
+
+    def get(self, team_name, task_id):
+        with self.lock:
+            return self.tokens.get((team_name, task_id))
+
+    def set(self, team_name, task_id, token):
+        with self.lock:
+            self.tokens[(team_name, task_id)] = token
+
+    def invalidate_team(self, team_name):
+        with self.lock:
+            for key in [key for key in self.tokens if key[0] == team_name]:
+                del self.tokens[key]
+
+    def invalidate_task(self, task_id):
+        with self.lock:
+            for key in [key for key in self.tokens if key[1] == task_id]:
+                del self.tokens[key]
+
+    def clear(self):
+        with self.lock:
+            self.tokens.clear()
+
+
+token_cache = TokenCache()
+
+
+def invalidate_tokens(team_names):
+    # A team deleted and registered again by another process has a new seed
+    if team_names is None:
+        token_cache.clear()
+        return
+    for team_name in team_names:
+        token_cache.invalidate_team(team_name)
+
+
+class FlagMatcherCache:
+    # Generated tasks are read from disk on every request, so their flag matchers are kept here
+    # and reused while the instance's task.json stays the same. The least recently used are dropped
+    def __init__(self):
+        self.lock = Lock()
+        self.entries = OrderedDict()
+
+    def get(self, task, token, signature):
+        key = (task.task_id, token)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self.entries.move_to_end(key)
+                return entry[1]
+        flag_matcher = tasks.FlagMatcher(task.flags)
+        with self.lock:
+            self.entries[key] = (signature, flag_matcher)
+            self.entries.move_to_end(key)
+            while len(self.entries) > configuration['flag_matcher_cache_size']:
+                self.entries.popitem(last=False)
+        return flag_matcher
+
+
+flag_matcher_cache = FlagMatcherCache()
+
+
 def get_token(team_name, task_id):
+    token = token_cache.get(team_name, task_id)
+    if token is not None:
+        return token
+
     task = tasks.read_task(task_id)
-    
-    team_seed = team.read_team(team_name).seed
+
+    team_seed = team.get_team_basic_info(team_name)['seed']
     task_seed = task.get_seed()
     ctfhost_seed = util.get_ctfhost_seed()
 
-    return hashlib.sha224(
+    token = hashlib.sha224(
         'team:{},task:{},glob:{};'.format(
             team_seed,
             task_seed,
             ctfhost_seed
         ).encode()
     ).hexdigest()
+    token_cache.set(team_name, task_id, token)
+    return token
+
+
+class GeneratorRegistry:
+    # Generation configs are resolved through task -> group -> ... -> 'noop' preset on every lookup,
+    # which costs one stat() per level. File contents are cached by their stat signature and compiled
+    # generator modules by their path and source hash. Tasks inheriting a config share its module, whose
+    # __file__ is the inherited file, but identical copies of a config in different places do not
+    def __init__(self):
+        self.lock = RLock()
+        self.sources = {}
+        self.modules = {}
+
+    def read_source(self, path):
+        try:
+            file_stat = os.stat(path)
+        except OSError:
+            return None
+        signature = (file_stat.st_mtime_ns, file_stat.st_size)
+        with self.lock:
+            cached = self.sources.get(path)
+            if cached is not None and cached[0] == signature:
+                return cached[1]
+        with open(path) as f:
+            source = f.read()
+        entry = (path, source, hashlib.sha256(source.encode()).hexdigest())
+        with self.lock:
+            self.sources[path] = (signature, entry)
+        return entry
+
+    def resolve_preset(self, preset_name):
+        presets_dir = configuration['gen_config_presets_path']
+        entry = self.read_source(os.path.join(presets_dir, preset_name + '.py'))
+        if entry is None:
+            raise PresetNotFoundError()
+        return entry
+
+    def resolve_group(self, group_id, max_depth=30):
+        for i in range(max_depth):
+            if group_id == 0:
+                break
+            entry = self.read_source(get_group_generation_config_path(group_id))
+            if entry is not None:
+                return entry
+            group_id = tasks.group_tree.get(group_id)['parent']
+        return self.resolve_preset('noop')
+
+    def resolve_task(self, task_id):
+        entry = self.read_source(get_task_generation_config_path(task_id))
+        if entry is not None:
+            return entry
+        return self.resolve_group(tasks.read_task(task_id, validate=False).group)
+
+    def get_module(self, task_id):
+        path, source, source_hash = self.resolve_task(task_id)
+        with self.lock:
+            cached = self.modules.get(path)
+            if cached is not None and cached[0] == source_hash:
+                return cached[1]
+            logger.info('Compiling task generator {}', path)
+            mod = types.ModuleType('generator_' + source_hash[:16])
+            mod.__file__ = path
+            exec(compile(source, path, 'exec'), mod.__dict__)
+            # Replaces the module compiled from an older version of the file
+            self.modules[path] = (source_hash, mod)
+            return mod
+
+    def invalidate(self, path):
+        # A rewrite may keep both the size and the mtime (on filesystems with coarse timestamps)
+        with self.lock:
+            self.sources.pop(path, None)
+
+
+generator_registry = GeneratorRegistry()
+
+
+def get_task_generation_config_path(task_id):
+    return os.path.join(configuration['tasks_path'], str(task_id), 'generate.py')
+
+
+def get_group_generation_config_path(group_id):
+    return os.path.join(configuration['groups_path'], str(group_id), 'generate.py')
 
 
 def read_preset(preset_name):
-    presets_dir = configuration['gen_config_presets_path']
-    os.makedirs(presets_dir, exist_ok=True)
-    preset_filename = os.path.join(presets_dir, preset_name + '.py')
-    if not os.access(preset_filename, os.R_OK):
-        raise PresetNotFoundError()
-    with open(preset_filename) as f:
-        return f.read()
+    os.makedirs(configuration['gen_config_presets_path'], exist_ok=True)
+    return generator_registry.resolve_preset(preset_name)[1]
     
 
 def make_task_generation_config_from_preset(task_id, preset_name):
-    if type(task_id) is not int:
-        raise tasks.TaskNotFoundError()
-    task_dir = os.path.join(configuration['tasks_path'], str(task_id))
-    if not os.access(task_dir, os.R_OK | os.X_OK):
-        raise tasks.TaskNotFoundError()
-
-    preset = read_preset(preset_name)
     logger.info('Making task ({}) generation config from preset "{}"', task_id, preset_name)
-    task_gen_file = os.path.join(task_dir, 'generate.py')
-
-    with open(task_gen_file, 'w') as f:
-        f.write(preset)
+    write_task_generation_config(task_id, read_preset(preset_name))
 
 
 def read_task_generation_config(task_id):
@@ -65,59 +213,21 @@ def read_task_generation_config(task_id):
     task_dir = os.path.join(configuration['tasks_path'], str(task_id))
     if not os.access(task_dir, os.R_OK | os.X_OK):
         raise tasks.TaskNotFoundError()
-    task_gen_file = os.path.join(task_dir, 'generate.py')
-    if not os.access(task_gen_file, os.R_OK):
-        make_default_task_generation_config(task_id)
-    with open(task_gen_file) as f:
-        return f.read()
-
-
-def make_default_task_generation_config(task_id):
-    task = tasks.read_task(task_id)
-    if task.group == 0:
-        make_task_generation_config_from_preset(task_id, 'noop')
-    else:
-        # Guarantees that config will be available at the moment of exit
-        write_task_generation_config(task_id, read_group_generation_config(task.group))
-        logger.info('Inheriting task ({}) generation config from group ({})', task_id, task.group)
+    return generator_registry.resolve_task(task_id)[1]
     
 
 def make_group_generation_config_from_preset(group_id, preset_name):
-    if type(group_id) is not int:
-        raise groups.GroupNotFoundError()
-    group_dir = os.path.join(configuration['groups_path'], str(group_id))
-    if not os.access(group_dir, os.R_OK | os.X_OK):
-        raise groups.GroupNotFoundError()
-
-    preset = read_preset(preset_name)
     logger.info('Making group ({}) generation config from preset "{}"', group_id, preset_name)
-    group_gen_file = os.path.join(group_dir, 'generate.py')
-
-    with open(group_gen_file, 'w') as f:
-        f.write(preset)
+    write_group_generation_config(group_id, read_preset(preset_name))
 
 
 def read_group_generation_config(group_id):
     if type(group_id) is not int:
-        raise groups.GroupNotFoundError()
+        raise tasks.GroupNotFoundError()
     group_dir = os.path.join(configuration['groups_path'], str(group_id))
     if not os.access(group_dir, os.R_OK | os.X_OK):
-        raise groups.GroupNotFoundError()
-    group_gen_file = os.path.join(group_dir, 'generate.py')
-    if not os.access(group_gen_file, os.R_OK):
-        make_default_group_generation_config(group_id)
-    with open(group_gen_file) as f:
-        return f.read()
-
-
-def make_default_group_generation_config(group_id):
-    group = tasks.read_group(group_id)
-    if group['parent'] == 0:
-        make_group_generation_config_from_preset(group_id, 'noop')
-    else:
-        # Guarantees that config will be available at the moment of exit
-        write_group_generation_config(group_id, read_group_generation_config(group['parent']))
-        logger.info('Inheriting group ({}) generation config from group ({})', group_id, group['parent'])
+        raise tasks.GroupNotFoundError()
+    return generator_registry.resolve_group(group_id)[1]
 
 
 def write_task_generation_config(task_id, config):
@@ -126,27 +236,106 @@ def write_task_generation_config(task_id, config):
     task_dir = os.path.join(configuration['tasks_path'], str(task_id))
     if not os.access(task_dir, os.R_OK | os.X_OK):
         raise tasks.TaskNotFoundError()
-    task_gen_file = os.path.join(task_dir, 'generate.py')
-    with open(task_gen_file, 'w') as f:
-        f.write(config)
+    task_gen_file = get_task_generation_config_path(task_id)
+    with locks.catalog_lock.write():
+        with open(task_gen_file, 'w') as f:
+            f.write(config)
+        generator_registry.invalidate(task_gen_file)
 
 
 def write_group_generation_config(group_id, config):
     if type(group_id) is not int:
-        raise groups.TaskNotFoundError()
+        raise tasks.GroupNotFoundError()
     group_dir = os.path.join(configuration['groups_path'], str(group_id))
     if not os.access(group_dir, os.R_OK | os.X_OK):
-        raise groups.TaskNotFoundError()
-    group_gen_file = os.path.join(group_dir, 'generate.py')
-    with open(group_gen_file, 'w') as f:
-        f.write(config)
+        raise tasks.GroupNotFoundError()
+    group_gen_file = get_group_generation_config_path(group_id)
+    with locks.catalog_lock.write():
+        with open(group_gen_file, 'w') as f:
+            f.write(config)
+        generator_registry.invalidate(group_gen_file)
+
+
+class GenerationManifest:
+    # Records the inputs each generated instance was built from. Up-to-date instances are
+    # answered from memory, the database is consulted only when memory has no matching record
+    def __init__(self):
+        self.lock = Lock()
+        self.records = {}
+
+    def is_up_to_date(self, task_id, token, input_hash):
+        with self.lock:
+            if self.records.get((task_id, token)) == (input_hash, 'ok'):
+                return True
+        with database.connect() as db:
+            cur = db.cursor()
+            cur.execute(
+                'SELECT input_hash, status FROM generated_tasks WHERE task_id = ? AND token = ? LIMIT 1',
+                (task_id, token)
+            )
+            record = cur.fetchone()
+        if record is None:
+            return False
+        with self.lock:
+            self.records[(task_id, token)] = tuple(record)
+        return tuple(record) == (input_hash, 'ok')
+
+    def record(self, task_id, token, input_hash, status):
+        with database.connect() as db:
+            cur = db.cursor()
+            cur.execute(
+                'INSERT OR REPLACE INTO generated_tasks VALUES (?, ?, ?, ?, ?)',
+                (task_id, token, input_hash, status, int(time.time()))
+            )
+            db.commit()
+        with self.lock:
+            self.records[(task_id, token)] = (input_hash, status)
+
+    def forget_task(self, task_id):
+        with database.connect() as db:
+            cur = db.cursor()
+            cur.execute('DELETE FROM generated_tasks WHERE task_id = ?', (task_id,))
+            db.commit()
+        with self.lock:
+            for key in [key for key in self.records if key[0] == task_id]:
+                del self.records[key]
+
+
+generation_manifest = GenerationManifest()
+task_input_hashes = {}
+
+
+def get_task_input_hash(task_id):
+    # Hash of everything a generator gets from the task itself: task.json fields and the (possibly inherited)
+    # generator source. Recomputed only when the task catalog reloads the task or the generator changes
+    source_hash = generator_registry.resolve_task(task_id)[2]
+    version = (tasks.task_catalog.get_version(task_id), source_hash)
+    cached = task_input_hashes.get(task_id)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    task = tasks.read_task(task_id, validate=False)
+    data = json.dumps({'task': task.to_dict(False), 'generator': source_hash}, sort_keys=True)
+    input_hash = hashlib.sha256(data.encode()).hexdigest()
+    task_input_hashes[task_id] = (version, input_hash)
+    return input_hash
+
+
+def get_input_hash(task_id, token):
+    # The token covers the team, task and global seeds
+    return hashlib.sha256('{}:{}'.format(get_task_input_hash(task_id), token).encode()).hexdigest()
 
 
 def get_generated_task(task_id, token, team):
     if not tasks.task_exists(task_id):
         raise tasks.TaskNotFoundError(task_id)
     maybe_generate(task_id, token, team)
-    return read_generated_task(task_id, token)
+    try:
+        return read_generated_task(task_id, token)
+    except tasks.TaskNotFoundError:
+        # The instance was removed from disk although the manifest says it is up-to-date
+        with locks.generation_lock(task_id, token):
+            generate(task_id, token, team)
+        return read_generated_task(task_id, token)
 
 
 def read_generated_task(task_id, token):
@@ -156,74 +345,59 @@ def read_generated_task(task_id, token):
     task_file = os.path.join(task_dir, 'task.json')
     try:
         with open(task_file) as f:
+            task_stat = os.fstat(f.fileno())
             task_str = f.read()
-        task = json.loads(task_str)
-        return tasks.Task(task_id, task)
+        task = tasks.Task(task_id, json.loads(task_str))
     except FileNotFoundError:
         raise tasks.TaskNotFoundError(task_id)
+    signature = (task_stat.st_mtime_ns, task_stat.st_size)
+    task.set_flag_matcher(flag_matcher_cache.get(task, token, signature))
+    return task
 
 
 def write_generated_task(task, token):
     task_id = task.task_id
     if type(task_id) is not int:
-        raise TaskNotFoundError(task_id)
+        raise tasks.TaskNotFoundError(task_id)
     task_dir = os.path.join(configuration['tasks_path'], str(task_id), 'generated', str(token))
     os.makedirs(task_dir, exist_ok=True)
     task_file = os.path.join(task_dir, 'task.json')
     obj = task.to_dict(False)
-    with open(task_file, 'w') as f:
+    # Readers don't take the generation lock, so they must never see a half-written file
+    with open(task_file + '.tmp', 'w') as f:
         f.write(json.dumps(obj))
+    os.replace(task_file + '.tmp', task_file)
 
 
 def maybe_generate(task_id, token, team):
-    read_task_generation_config(task_id)    # Make sure that the config is available
-    if should_generate(task_id, token):
-        generate(task_id, token, team)
-
-
-def should_generate(task_id, token):
-    task_dir = os.path.join(configuration['tasks_path'], str(task_id), 'generated', str(token))
-    if not os.access(task_dir, os.F_OK):
-        return True
-    try:
-        gen_ts = get_generation_timestamp(task_id, token)
-    except BaseException:
-        return True
-    conf_ts = get_config_modification_timestamp(task_id)
-    task_ts = get_task_modification_timestamp(task_id)
-    return gen_ts < conf_ts or gen_ts < task_ts
-
-
-def get_generation_timestamp(task_id, token):
-    task_dir = os.path.join(configuration['tasks_path'], str(task_id), 'generated', str(token))
-    with open(os.path.join(task_dir, 'gen_ts')) as f:
-        return float(f.read())
-
-
-def get_config_modification_timestamp(task_id):
-    task_dir = os.path.join(configuration['tasks_path'], str(task_id))
-    task_gen_file = os.path.join(task_dir, 'generate.py')
-    return os.stat(task_gen_file).st_mtime
-
-
-def get_task_modification_timestamp(task_id):
-    task_dir = os.path.join(configuration['tasks_path'], str(task_id))
-    task_json_file = os.path.join(task_dir, 'task.json')
-    return os.stat(task_json_file).st_mtime
+    with locks.generation_lock(task_id, token):
+        with locks.catalog_lock.read():
+            input_hash = get_input_hash(task_id, token)
+        if not generation_manifest.is_up_to_date(task_id, token, input_hash):
+            generate(task_id, token, team)
 
 
 def generate(task_id, token, team):
-    read_task_generation_config(task_id)    # Make sure that the config is available
+    # Must be called with the generation lock of the instance held. The catalog lock is held only while
+    # the inputs are read: a slow generator must not keep admin changes (and the readers queued behind them) waiting.
+    # If the task changes meanwhile, the recorded input hash is outdated and the instance is generated again
+    with locks.catalog_lock.read():
+        input_hash = get_input_hash(task_id, token)
     logger.info('Generating task {} with token {}', task_id, token)
     task_dir = os.path.join(configuration['tasks_path'], str(task_id))
     os.makedirs(task_dir, exist_ok=True)
 
-    mod = util.import_file(os.path.join(task_dir, 'generate.py'))
-    raw_task = tasks.read_task(task_id)
-    gen_task = mod.generate(task=raw_task, token=token, team=team)
-    write_generated_task(gen_task, token)
-    with open(os.path.join(task_dir, 'generated', token, 'gen_ts'), 'w') as f:
-        f.write(str(time.time()))
+    try:
+        with locks.catalog_lock.read():
+            mod = generator_registry.get_module(task_id)
+            raw_task = tasks.read_task(task_id)
+        gen_task = mod.generate(task=raw_task, token=token, team=team)
+        write_generated_task(gen_task, token)
+        tasks.markdown_cache.render(gen_task.text)
+    except BaseException:
+        generation_manifest.record(task_id, token, input_hash, 'failed')
+        raise
+    generation_manifest.record(task_id, token, input_hash, 'ok')
 
 
 def get_generated_task_list(team_name):
@@ -232,7 +406,7 @@ def get_generated_task_list(team_name):
         yield get_generated_task(task_id=task.task_id, token=token, team=team.read_team(team_name))
 
 
-def api_update_gen_config(api, sess, args):
+async def api_update_gen_config(api, sess, args):
     http = args['http_handler']
     request = json.loads(http.request.body)
     what       = request['what']
@@ -250,7 +424,7 @@ def api_update_gen_config(api, sess, args):
                 )
             )
         
-        write_task_generation_config(task_id, new_config)
+        await aio.run_in_executor(write_task_generation_config, task_id, new_config)
         http.write(json.dumps({'success': True}))
     elif what == 'group':
         group_id = request['group_id']
@@ -264,9 +438,12 @@ def api_update_gen_config(api, sess, args):
                 )
             )
         
-        write_group_generation_config(group_id, new_config)
+        await aio.run_in_executor(write_group_generation_config, group_id, new_config)
         http.write(json.dumps({'success': True}))
     else:
         raise ApiArgumentError('what')
 
 api.add('update_gen_config', api_update_gen_config, access_level=ADMIN)
+
+
+shared_state.watch('scoreboard', invalidate_tokens, keyed=True)
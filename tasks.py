@@ -1,28 +1,34 @@
-import sqlite3
+import copy
+import hashlib
 import json
 import os
 import re
 import shutil
+import sqlite3
 import time
 import secrets
-import subprocess as sp
 import traceback as bt
-from contextlib import closing
-from threading import Lock
+from threading import Lock, RLock
+from collections import OrderedDict
 
 import markdown as md
 from loguru import logger
 
+import aio
+import checkers
+import database
+import locks
+import ratelimit
 import team
+import util
 import task_gen
+import prewarm
 from configuration import configuration
 from api import api, GUEST, USER, ADMIN, ApiArgumentError
 from localization import lc
 from competition import competition
-
-
-last_solves = {}
-last_solves_lock = Lock()
+from scoreboard import scoreboard
+from shared_state import shared_state
 
 
 class EmptyTaskNameError(Exception):
@@ -69,6 +75,10 @@ class InvalidInheritError(Exception):
         return 'err_invalid_inherit'
 
 
+class TaskLoadError(Exception):
+    pass
+
+
 class AttachmentNotFoundError(Exception):
     def __str__(self):
         return 'err_attachment_not_found'
@@ -78,18 +88,31 @@ class AttachmentNotFoundError(Exception):
 def get_attachment(task_id, team_name, filename):
     token = task_gen.get_token(task_id=task_id, team_name=team_name)
     path = os.path.join(configuration['tasks_path'], str(task_id), 'generated', token, 'files', filename)
-    if os.path.isfile(path):
-        return path
-    else:
-        raise AttachmentNotFoundError()
+    with locks.catalog_lock.read():
+        if os.path.isfile(path):
+            return path
+        else:
+            raise AttachmentNotFoundError()
 
 
-def check_flag_with_program(prog, flag, task, token, team_name):
+async def check_flag_with_program(flag_checker, flag, task, token, team_name):
     task_dir = os.path.join(configuration['tasks_path'], str(task.task_id))
+    prog = flag_checker['data']
     prog = prog.replace('@task_dir@', task_dir)
     prog = prog.replace('@team_name@', team_name)
-    result = sp.run([prog], text=True, input='\n'.join([str(task.task_id), flag, token, team_name]))
-    return result.returncode == 0
+    try:
+        return await checkers.checker_pool.check(
+            prog,
+            daemon = bool(flag_checker.get('daemon', False)),
+            timeout = flag_checker.get('timeout'),
+            task_id = task.task_id,
+            flag = flag,
+            token = token,
+            team_name = team_name,
+        )
+    except checkers.CheckerError as e:
+        logger.error('Flag checker of task {} failed: {}', task.task_id, str(e))
+        return False
 
 
 def get_attached_files(task_id, token):
@@ -103,6 +126,59 @@ def get_attached_files(task_id, token):
             yield entry.name
 
 
+MARKDOWN_EXTENSIONS = ('sane_lists', 'extra', 'codehilite')
+
+
+class MarkdownCache:
+    # Rendered task texts, keyed by a hash of the text and the extensions, so teams whose
+    # generated texts are identical share an entry. The least recently used entries are dropped
+    def __init__(self):
+        self.lock = Lock()
+        self.entries = OrderedDict()
+
+    def render(self, text, extensions=MARKDOWN_EXTENSIONS):
+        key = hashlib.sha256(json.dumps([text, list(extensions)]).encode()).hexdigest()
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        html = md.markdown(text, extensions=list(extensions))
+        with self.lock:
+            self.entries[key] = html
+            while len(self.entries) > configuration['markdown_cache_size']:
+                self.entries.popitem(last=False)
+        return html
+
+
+markdown_cache = MarkdownCache()
+
+
+class FlagMatcher:
+    # Compiled form of a task's flag checkers: exact strings in a set, regexes compiled once,
+    # and the checker programs, which are the slowest and so are tried last
+    def __init__(self, flags):
+        self.strings = set()
+        self.regexes = []
+        self.programs = []
+        for flag_checker in flags:
+            fc_type = flag_checker['type']
+            fc_data = flag_checker['data']
+            if fc_type == 'string':
+                self.strings.add(fc_data)
+            elif fc_type == 'regex':
+                self.regexes.append(re.compile(fc_data))
+            elif fc_type == 'program':
+                self.programs.append(flag_checker)
+
+    def match_static(self, flag):
+        if flag in self.strings:
+            return True
+        for regex in self.regexes:
+            if regex.match(flag) is not None:
+                return True
+        return False
+
+
 class Task:
     def __init__(self, task_id, info, validate=True):
         self.task_id     = task_id
@@ -118,6 +194,9 @@ class Task:
         self.files       = list(get_attached_files(task_id, None))
         self.genfiles    = self.Genfiles(task_id)
 
+        self.flag_matcher        = None
+        self.flag_matcher_source = None
+
         if validate:
             self.validate()
 
@@ -125,6 +204,9 @@ class Task:
         return list(get_attached_files(self.task_id, token))
 
     class Genfiles:
+        # Generated files start as reflinks or hardlinks of the task files (see link_tree), so a team
+        # instance only takes disk space for the files its generator changes. Hardlinked files must not
+        # be modified in place: use materialize or write_file, which give the instance its own copy
         def __init__(self, task_id):
             self.task_id = task_id
             self.src_path = os.path.join(configuration['tasks_path'], str(task_id), 'files')
@@ -137,9 +219,38 @@ class Task:
             if os.path.exists(path):
                 shutil.rmtree(path)
 
+        def link_tree(self, token):
+            self.prepare(token)
+            gen_path = self.get_gen_path(token)
+            os.makedirs(self.src_path, exist_ok=True)
+            for src_dir, dirnames, filenames in os.walk(self.src_path):
+                gen_dir = os.path.join(gen_path, os.path.relpath(src_dir, self.src_path))
+                os.makedirs(gen_dir, exist_ok=True)
+                for filename in filenames:
+                    util.clone_file(os.path.join(src_dir, filename), os.path.join(gen_dir, filename))
+            return gen_path
+
+        def materialize(self, token, filename):
+            # Returns the path of the instance's file, replacing a hardlink with a private copy
+            path = os.path.join(self.get_gen_path(token), filename)
+            if os.stat(path).st_nlink > 1:
+                tmp_path = path + '.tmp'
+                shutil.copy2(path, tmp_path)
+                os.replace(tmp_path, path)
+            return path
+
+        def write_file(self, token, filename, data):
+            path = os.path.join(self.get_gen_path(token), filename)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb' if isinstance(data, bytes) else 'w') as f:
+                f.write(data)
+            # Replacing the directory entry leaves the task file behind a hardlink untouched
+            os.replace(tmp_path, path)
+            return path
+
     def get_pretty_text(self):
-        # TODO: maybe cache the resulting HTML is the performance boost is noticeable
-        return md.markdown(self.text, extensions=['sane_lists', 'extra', 'codehilite'])
+        return markdown_cache.render(self.text)
 
     def validate(self):
         self.validate_flags()
@@ -151,7 +262,7 @@ class Task:
             return self.seed
         if self.group == 0:
             raise InvalidInheritError()
-        return get_group_seed(read_group(self.group))
+        return group_tree.get_seed(self.group)
 
     def validate_hints(self):
         if type(self.hints) is not list:
@@ -200,104 +311,308 @@ class Task:
             'files':   self.files,
         }
 
-    def check_flag(self, flag, team_name):
+    def get_flag_matcher(self):
+        # Built on first use, and again if the flags are replaced. Flags changed in place are not noticed
+        if self.flag_matcher is None or self.flag_matcher_source is not self.flags:
+            self.set_flag_matcher(FlagMatcher(self.flags))
+        return self.flag_matcher
+
+    def set_flag_matcher(self, flag_matcher):
+        self.flag_matcher = flag_matcher
+        self.flag_matcher_source = self.flags
+
+    async def check_flag(self, flag, team_name, token=None):
         logger.info('Checking flag {}', repr(flag))
-        now = time.time()
-        global last_solves, last_solves_lock
-        with last_solves_lock:
-            if team_name in last_solves:
-                if last_solves[team_name] + configuration['min_submission_interval'] > now:
-                    raise TooFrequentSubmissions()
-            last_solves[team_name] = now
-        for flag_checker in self.flags:
-            fc_type = flag_checker['type']
-            fc_data = flag_checker['data']
-            if fc_type == 'string':
-                if flag == fc_data:
-                    return True
-            elif fc_type == 'regex':
-                if re.match(fc_data, flag) is not None:
-                    return True
-            elif fc_type == 'program':
-                if check_flag_with_program(
-                    prog = fc_data,
-                    flag = flag,
-                    task = self,
-                    token = task_gen.get_token(team_name, self.task_id),
-                    team_name = team_name
-                ):
-                    return True
+        flag_matcher = self.get_flag_matcher()
+        if flag_matcher.match_static(flag):
+            return True
+        if len(flag_matcher.programs) > 0 and token is None:
+            token = task_gen.get_token(team_name, self.task_id)
+        for flag_checker in flag_matcher.programs:
+            if await check_flag_with_program(flag_checker, flag, task=self, token=token, team_name=team_name):
+                return True
         return False
 
     def strip_private_data(self):
         self.flags = []
 
 
+class TaskCatalog:
+    # Keeps parsed tasks in memory. Admin write paths reload the tasks they change,
+    # edits made directly on disk are picked up by comparing file metadata at most
+    # once per catalog_check_interval seconds
+    def __init__(self):
+        self.lock = RLock()
+        self.entries = {}
+        self.last_check = None
+
+    def get_signature(self, task_id):
+        task_dir = os.path.join(configuration['tasks_path'], str(task_id))
+        try:
+            task_stat = os.stat(os.path.join(task_dir, 'task.json'))
+        except OSError:
+            return None
+        try:
+            files_mtime = os.stat(os.path.join(task_dir, 'files')).st_mtime_ns
+        except OSError:
+            files_mtime = None
+        try:
+            gen_stat = os.stat(os.path.join(task_dir, 'generate.py'))
+            gen_signature = (gen_stat.st_mtime_ns, gen_stat.st_size)
+        except OSError:
+            gen_signature = None
+        return (task_stat.st_mtime_ns, task_stat.st_size, files_mtime, gen_signature)
+
+    def scan(self):
+        tasks_path = configuration['tasks_path']
+        os.makedirs(tasks_path, exist_ok=True)
+        signatures = {}
+        for entry in os.scandir(tasks_path):
+            if not entry.is_dir() or re.match(r'^[1-9][0-9]*$', entry.name) is None:
+                continue
+            signature = self.get_signature(int(entry.name))
+            if signature is not None:
+                signatures[int(entry.name)] = signature
+        return signatures
+
+    def refresh(self, force=False):
+        with self.lock:
+            now = time.monotonic()
+            interval = configuration['catalog_check_interval']
+            if not force and self.last_check is not None and now - self.last_check < interval:
+                return
+            self.last_check = now
+            signatures = self.scan()
+            for task_id in list(self.entries):
+                if task_id not in signatures:
+                    logger.info('Task {} disappeared from disk', task_id)
+                    self.remove(task_id)
+            for task_id, signature in signatures.items():
+                if task_id not in self.entries or self.entries[task_id][0] != signature:
+                    self.load(task_id, signature)
+
+    def load(self, task_id, signature):
+        try:
+            task = load_task(task_id)
+        except Exception as e:
+            logger.warning('Error loading task info: {}', repr(e))
+            # Only the message is kept: raising the same exception object over and over would make its traceback grow
+            task = TaskLoadError(task_id, repr(e))
+        self.entries[task_id] = (signature, task)
+        # The seed or the group (and so the inherited seed) may have changed
+        task_gen.token_cache.invalidate_task(task_id)
+
+    def remove(self, task_id):
+        self.entries.pop(task_id, None)
+        task_gen.token_cache.invalidate_task(task_id)
+
+    def reload(self, task_id):
+        with self.lock:
+            signature = self.get_signature(task_id)
+            if signature is None:
+                self.remove(task_id)
+            else:
+                self.load(task_id, signature)
+
+    def get(self, task_id):
+        self.refresh()
+        with self.lock:
+            if task_id not in self.entries:
+                raise TaskNotFoundError()
+            task = self.entries[task_id][1]
+        if isinstance(task, Exception):
+            raise TaskLoadError(*task.args)
+        return task
+
+    def exists(self, task_id):
+        self.refresh()
+        with self.lock:
+            return task_id in self.entries
+
+    def get_version(self, task_id):
+        # Changes whenever the task or its generation config changes
+        self.refresh()
+        with self.lock:
+            if task_id not in self.entries:
+                raise TaskNotFoundError()
+            return self.entries[task_id][0]
+
+    def get_task_ids(self):
+        self.refresh()
+        with self.lock:
+            return list(self.entries)
+
+
+task_catalog = TaskCatalog()
+
+
+class GroupTree:
+    # In-memory index of all groups with precomputed paths and resolved seeds. It is
+    # rebuilt whenever a group changes, either through write_group/delete_group or on disk
+    def __init__(self):
+        self.lock = RLock()
+        self.groups = {}
+        self.signatures = {}
+        self.paths = {}
+        self.seeds = {}
+        self.last_check = None
+
+    def get_signature(self, group_id):
+        try:
+            group_stat = os.stat(os.path.join(configuration['groups_path'], str(group_id), 'group.json'))
+        except OSError:
+            return None
+        return (group_stat.st_mtime_ns, group_stat.st_size)
+
+    def scan(self):
+        groups_path = configuration['groups_path']
+        os.makedirs(groups_path, exist_ok=True)
+        signatures = {}
+        for entry in os.scandir(groups_path):
+            if not entry.is_dir() or re.match(r'^[1-9][0-9]*$', entry.name) is None:
+                continue
+            signature = self.get_signature(int(entry.name))
+            if signature is not None:
+                signatures[int(entry.name)] = signature
+        return signatures
+
+    def refresh(self, force=False):
+        with self.lock:
+            now = time.monotonic()
+            interval = configuration['catalog_check_interval']
+            if not force and self.last_check is not None and now - self.last_check < interval:
+                return
+            self.last_check = now
+            signatures = self.scan()
+            if signatures == self.signatures:
+                return
+            groups = {}
+            for group_id, signature in signatures.items():
+                if self.signatures.get(group_id) == signature and group_id in self.groups:
+                    groups[group_id] = self.groups[group_id]
+                    continue
+                try:
+                    groups[group_id] = load_group(group_id)
+                except Exception as e:
+                    logger.warning('Error loading group info: {}', repr(e))
+            self.groups = groups
+            self.signatures = signatures
+            self.build_index()
+
+    def build_index(self):
+        old_seeds = self.seeds
+        self.paths = {group_id: self.build_path(group_id) for group_id in self.groups}
+        self.seeds = {group_id: self.resolve_seed(group_id) for group_id in self.groups}
+        if self.seeds != old_seeds:
+            # Tasks with inherited seeds may have got different tokens
+            task_gen.token_cache.clear()
+
+    def build_path(self, group_id, max_depth=30):
+        path = []
+        for i in range(max_depth):
+            if group_id == 0:
+                return list(reversed(path))
+            if group_id not in self.groups:
+                return None
+            group = self.groups[group_id]
+            path.append(group['name'])
+            group_id = group['parent']
+        path.append('...')
+        return list(reversed(path))
+
+    def resolve_seed(self, group_id):
+        visited = set()
+        while True:
+            if group_id not in self.groups:
+                return GroupNotFoundError()
+            group = self.groups[group_id]
+            if group['seed'] != 'inherit':
+                return group['seed']
+            visited.add(group_id)
+            group_id = group['parent']
+            if group_id == 0 or group_id in visited:
+                return InvalidInheritError()
+
+    def get(self, group_id):
+        self.refresh()
+        with self.lock:
+            if group_id not in self.groups:
+                raise GroupNotFoundError()
+            return dict(self.groups[group_id])
+
+    def exists(self, group_id):
+        self.refresh()
+        with self.lock:
+            return group_id in self.groups
+
+    def get_all(self):
+        self.refresh()
+        with self.lock:
+            return [dict(group) for group in self.groups.values()]
+
+    def get_path(self, group_id):
+        if group_id == 0:
+            return []
+        self.refresh()
+        with self.lock:
+            path = self.paths.get(group_id)
+        if path is None:
+            raise GroupNotFoundError()
+        return path
+
+    def get_seed(self, group_id):
+        self.refresh()
+        with self.lock:
+            if group_id not in self.seeds:
+                raise GroupNotFoundError()
+            seed = self.seeds[group_id]
+        if isinstance(seed, Exception):
+            raise type(seed)()
+        return seed
+
+    def may_reparent(self, group_id, new_parent):
+        self.refresh()
+        with self.lock:
+            if group_id not in self.groups:
+                raise GroupNotFoundError()
+            group_ids = set([group_id])
+            parent_id = new_parent
+            while parent_id != 0:
+                if parent_id in group_ids:
+                    # Not OK: loop
+                    return False
+                if parent_id not in self.groups:
+                    raise GroupNotFoundError()
+                group_ids.add(parent_id)
+                parent_id = self.groups[parent_id]['parent']
+            # OK, alternative path to root group
+            return True
+
+
+group_tree = GroupTree()
+
+
 def get_group_seed(group):
     if group['seed'] != 'inherit':
         return group['seed']
     if group['parent'] == 0:
         raise InvalidInheritError()
-    return get_group_seed(read_group(group['parent']))
+    return group_tree.get_seed(group['parent'])
 
 
 def get_task_list(validate=True):
-    tasks_path = configuration['tasks_path']
-    os.makedirs(tasks_path, exist_ok=True)
-    for task_dir in os.listdir(tasks_path):
+    for task_id in task_catalog.get_task_ids():
         try:
-            if not os.path.isdir(os.path.join(tasks_path, task_dir)):
-                continue
-            if re.match(r'^[1-9][0-9]*$', task_dir) is None:
-                continue
-            if not os.access(os.path.join(tasks_path, task_dir, 'task.json'), os.R_OK):
-                continue
-            task_id = int(task_dir)
             yield read_task(task_id, validate=validate)
         except Exception as e:
             bt.print_exc()
             logger.warning('Error loading task info: {}', repr(e))
 
 
-def read_group(group_id):
-    assert type(group_id) is int
-    group_dir = os.path.join(configuration['groups_path'], str(group_id))
-    group_file = os.path.join(group_dir, 'group.json')
-    try:
-        with open(group_file) as f:
-            group_str = f.read()
-        group = json.loads(group_str)
-        return {'group_id': group_id, 'name': group['name'], 'parent': group['parent'], 'seed': group['seed']}
-    except FileNotFoundError:
-        raise GroupNotFoundError()
-
-
-def write_group(group):
-    group_id = group.group_id
-    assert type(group_id) is int
-    group_dir = os.path.join(configuration['groups_path'], str(group_id))
-    os.makedirs(group_dir, exist_ok=True)
-    group_file = os.path.join(group_dir, 'group.json')
-    obj = group.to_dict(False)
-    with open(group_file, 'w') as f:
-        f.write(json.dumps(obj))
-
-
 def get_group_list():
-    groups_path = configuration['groups_path']
-    os.makedirs(groups_path, exist_ok=True)
-    for group_dir in os.listdir(groups_path):
-        try:
-            if not os.path.isdir(os.path.join(groups_path, group_dir)):
-                continue
-            if re.match(r'^[1-9][0-9]*$', group_dir) is None:
-                continue
-            if not os.access(os.path.join(groups_path, group_dir, 'group.json'), os.R_OK):
-                continue
-            group_id = int(group_dir)
-            yield read_group(group_id)
-        except Exception as e:
-            logger.warning('Error loading group info: {}', repr(e))
+    for group in group_tree.get_all():
+        yield group
+
 
 def get_group_dict():
     group_list = get_group_list()
@@ -307,23 +622,20 @@ def get_group_dict():
     return group_dict
 
 
-def build_group_path(groups, group_id, max_depth=30):
-    try:
-        path = []
-        for i in range(max_depth):
-            if group_id == 0:
-                return list(reversed(path))
-            group = groups[group_id]
-            path.append(group['name'])
-            group_id = group['parent']
-        path.append('...')
-        return list(reversed(path))
-    except BaseException as e:
-        logger.warning('Error building group path: {}', str(e))
-        raise
+def get_group_path(group_id):
+    return group_tree.get_path(group_id)
+
+
+def reload_catalog():
+    # Another process changed tasks or groups, don't wait for the next periodic check
+    task_catalog.refresh(force=True)
+    group_tree.refresh(force=True)
+
+
+shared_state.watch('catalog', reload_catalog)
 
 
-def api_add_or_update_task(api, sess, args):
+async def api_add_or_update_task(api, sess, args):
     http = args['http_handler']
     request = json.loads(http.request.body)
     task_id = request['task_id']
@@ -337,11 +649,11 @@ def api_add_or_update_task(api, sess, args):
     seed    = request['seed']
     hints   = request['hints']
 
-    if task_id is None or task_id == '':
-        task_id = allocate_task_id()
+    if task_id == '':
+        task_id = None
 
     try:
-        task_id = int(task_id)
+        task_id = int(task_id) if task_id is not None else None
     except (ValueError, TypeError) as e:
         raise Exception(
             lc.get('api_invalid_data_type').format(
@@ -390,45 +702,59 @@ def api_add_or_update_task(api, sess, args):
     if title == '':
         raise EmptyTaskNameError()
 
+    await aio.run_in_executor(
+        add_or_update_task,
+        task_id,
+        {
+            'title':  title,
+            'text':   text,
+            'value':  value,
+            'labels': labels,
+            'flags':  flags,
+            'group':  group,
+            'order':  order,
+            'seed':   seed,
+            'hints':  hints,
+        }
+    )
+    http.write(json.dumps({'success': True}))
+
+
+def add_or_update_task(task_id, info):
+    # Creates a task with a new ID if task_id is None
+    if task_id is None:
+        task_id = allocate_task_id()
     if task_exists(task_id):
         logger.info('Modifying task {}', task_id)
         task = read_task(task_id)
-        task.text = text
-        task.title = title
-        task.value = value
-        task.labels = labels
-        task.flags = flags
-        task.group = group
-        task.order = order
-        task.seed = seed
-        task.hints = hints
+        task.text = info['text']
+        task.title = info['title']
+        task.value = info['value']
+        task.labels = info['labels']
+        task.flags = info['flags']
+        task.group = info['group']
+        task.order = info['order']
+        task.seed = info['seed']
+        task.hints = info['hints']
         task.validate()
+        # Compiles the regexes, so that an invalid one is rejected here and not on submission
+        task.get_flag_matcher()
         write_task(task)
     else:
         logger.info('Creating task {}', task_id)
         try:
-            task = Task(
-                task_id,
-                {
-                    'title':  title,
-                    'text':   text,
-                    'value':  value,
-                    'labels': labels,
-                    'flags':  flags,
-                    'group':  group,
-                    'order':  order,
-                    'seed':   seed,
-                    'hints':  hints,
-                }
-            )
+            task = Task(task_id, info)
             task.validate()
+            task.get_flag_matcher()
         except KeyError as e:
             raise ApiArgumentError(lc.get('api_argument_error').format(argument=str(e)))
         write_task(task)
-    http.write(json.dumps({'success': True}))
+    markdown_cache.render(task.text)
+    prewarm.prewarmer.notify_task(task_id)
+    return task_id
 
 
-def api_add_group(api, sess, args):
+async def api_add_group(api, sess, args):
     http    = args['http_handler']
     request = json.loads(http.request.body)
     name    = request['name']
@@ -451,6 +777,12 @@ def api_add_group(api, sess, args):
 
     if name == '':
         raise EmptyGroupNameError()
+
+    await aio.run_in_executor(add_group, name, parent, seed)
+    http.write(json.dumps({'success': True}))
+
+
+def add_group(name, parent, seed):
     if parent != 0:
         read_group(parent)
 
@@ -458,10 +790,10 @@ def api_add_group(api, sess, args):
 
     logger.info('Creating group {} ({})', name, group_id)
     write_group(group_id, {'name': name, 'parent': parent, 'seed': seed})
-    http.write(json.dumps({'success': True}))
+    return group_id
 
 
-def api_rename_group(api, sess, args):
+async def api_rename_group(api, sess, args):
     http     = args['http_handler']
     request  = json.loads(http.request.body)
     group_id = request['group_id']
@@ -479,15 +811,18 @@ def api_rename_group(api, sess, args):
     if new_name == '':
         raise EmptyGroupNameError()
 
+    await aio.run_in_executor(rename_group, group_id, new_name)
+    http.write(json.dumps({'success': True}))
+
+
+def rename_group(group_id, new_name):
     logger.info('Renaming group ({}) to {}', group_id, new_name)
     group = read_group(group_id)
     group['name'] = new_name
-
     write_group(group_id, group)
-    http.write(json.dumps({'success': True}))
 
 
-def api_reparent_group(api, sess, args):
+async def api_reparent_group(api, sess, args):
     http     = args['http_handler']
     request  = json.loads(http.request.body)
     group_id = request['group_id']
@@ -502,17 +837,11 @@ def api_reparent_group(api, sess, args):
             )
         )
 
-    if may_reparent_group(group_id, new_parent):
-        logger.info('Reparenting group ({}): new parent: ({})', group_id, new_parent)
-        reparent_group(group_id, new_parent)
-    else:
-        logger.warning('Cannot reparent group ({}): new parent: ({})', group_id, new_parent)
-        raise GroupReparentError()
-
+    await aio.run_in_executor(try_reparent_group, group_id, new_parent)
     http.write(json.dumps({'success': True}))
 
 
-def api_update_group_seed(api, sess, args):
+async def api_update_group_seed(api, sess, args):
     http     = args['http_handler']
     request  = json.loads(http.request.body)
     group_id = request['group_id']
@@ -528,28 +857,20 @@ def api_update_group_seed(api, sess, args):
         )
     if (type(seed) is not str or len(seed) != 16) and seed != 'inherit':
         raise ApiArgumentError(lc.get('api_argument_error').format(argument='seed'))
+    await aio.run_in_executor(update_group_seed, group_id, seed)
+
+    http.write(json.dumps({'success': True}))
+
+
+def update_group_seed(group_id, seed):
     group = read_group(group_id)
     group['seed'] = seed
     get_group_seed(group)
     write_group(group_id, group)
 
-    http.write(json.dumps({'success': True}))
-
 
 def may_reparent_group(group_id, new_parent):
-    group_ids = set([group_id])
-    group = read_group(group_id)
-    group['parent'] = new_parent
-    while True:
-        parent_id = group['parent']
-        if parent_id == 0:
-            # OK, alternative path to root group
-            return True
-        elif parent_id in group_ids:
-            # Not OK: loop
-            return False
-        group_ids.add(parent_id)
-        group = read_group(parent_id)
+    return group_tree.may_reparent(group_id, new_parent)
 
 
 def reparent_group(group_id, new_parent):
@@ -558,7 +879,16 @@ def reparent_group(group_id, new_parent):
     write_group(group_id, group)
 
 
-def api_get_task(api, sess, args):
+def try_reparent_group(group_id, new_parent):
+    if may_reparent_group(group_id, new_parent):
+        logger.info('Reparenting group ({}): new parent: ({})', group_id, new_parent)
+        reparent_group(group_id, new_parent)
+    else:
+        logger.warning('Cannot reparent group ({}): new parent: ({})', group_id, new_parent)
+        raise GroupReparentError()
+
+
+async def api_get_task(api, sess, args):
     http = args['http_handler']
     request = json.loads(http.request.body)
     task_id = request['task_id']
@@ -573,14 +903,14 @@ def api_get_task(api, sess, args):
             )
         )
     try:
-        task = read_task(task_id)
+        task = await aio.run_in_executor(read_task, task_id)
     except TaskNotFoundError:
         raise Exception(lc.get('task_does_not_exist').format(task_id=task_id))
 
     http.write(json.dumps({'success': True, 'task': task.to_dict()}))
 
 
-def api_submit_flag(api, sess, args):
+async def api_submit_flag(api, sess, args):
     http = args['http_handler']
     request = json.loads(http.request.body)
     task_id = request['task_id']
@@ -599,28 +929,33 @@ def api_submit_flag(api, sess, args):
             )
         )
 
-    cteam = team.read_team(sess.username)
-    token = task_gen.get_token(sess.username, task_id)
-
-    try:
-        task = task_gen.get_generated_task(task_id, token, cteam)
-    except TaskNotFoundError:
+    if not await aio.run_in_executor(task_exists, task_id):
         raise Exception(lc.get('task_does_not_exist').format(task_id=task_id))
 
-    try:
-        correct = bool(task.check_flag(flag_data, team_name=sess.username))
-    except TooFrequentSubmissions:
+    # Throttle before anything expensive (token computation, task generation, flag checking programs)
+    rejected_by = await aio.run_in_executor(ratelimit.acquire_submission, sess.username, task_id)
+    if rejected_by is not None:
         logger.warning('Too frequent submissions from team {} for task with ID {}', sess.username, task_id)
         http.write(json.dumps({
             'success': False,
             'error_message': lc.get('task_submission_too_frequent').format(
-                time=configuration['min_submission_interval']
+                time=rejected_by.interval
             )
         }))
         return
 
+    cteam = await aio.read_team(sess.username)
+    token = await aio.run_in_executor(task_gen.get_token, sess.username, task_id)
+
     try:
-        team.add_submission(
+        task = await aio.get_generated_task(task_id, token, cteam)
+    except TaskNotFoundError:
+        raise Exception(lc.get('task_does_not_exist').format(task_id=task_id))
+
+    correct = bool(await task.check_flag(flag_data, team_name=sess.username, token=token))
+
+    try:
+        await aio.add_submission(
             team_name = sess.username,
             task_id = task_id,
             flag = flag_data,
@@ -641,7 +976,7 @@ def api_submit_flag(api, sess, args):
     http.write(json.dumps({'success': True, 'flag_correct': correct}))
 
 
-def api_delete_task(api, sess, args):
+async def api_delete_task(api, sess, args):
     http = args['http_handler']
     request = json.loads(http.request.body)
     task_id = request['task_id']
@@ -657,14 +992,14 @@ def api_delete_task(api, sess, args):
         )
     try:
         logger.info("Deleting task with id {}", task_id)
-        delete_task(task_id)
+        await aio.run_in_executor(delete_task, task_id)
     except TaskNotFoundError:
         raise Exception(lc.get('task_does_not_exist').format(task_id=task_id))
 
     http.write(json.dumps({'success': True}))
 
 
-def api_delete_group(api, sess, args):
+async def api_delete_group(api, sess, args):
     http = args['http_handler']
     request = json.loads(http.request.body)
     group_id = request['group_id']
@@ -679,7 +1014,7 @@ def api_delete_group(api, sess, args):
             )
         )
     logger.info("Deleting group ({})", group_id)
-    delete_group(group_id)
+    await aio.run_in_executor(delete_group, group_id)
 
     http.write(json.dumps({'success': True}))
 
@@ -688,23 +1023,31 @@ def delete_task(task_id):
     if type(task_id) is not int:
         # Security measure, because this function can potentially do something
         raise TaskNotFoundError()
-    if not task_exists(task_id):
-        raise TaskNotFoundError()
-    shutil.rmtree(os.path.join(configuration['tasks_path'], str(task_id)))
-    with closing(sqlite3.connect(configuration['db_path'])) as db:
+    with locks.catalog_lock.write():
+        if not task_exists(task_id):
+            raise TaskNotFoundError()
+        shutil.rmtree(os.path.join(configuration['tasks_path'], str(task_id)))
+        task_catalog.reload(task_id)
+        task_gen.generation_manifest.forget_task(task_id)
+    shared_state.bump('catalog')
+    with database.connect() as db:
         cur = db.cursor()
         cur.execute('DELETE FROM submissions WHERE task_id = ?', (task_id,))
         db.commit()
+    team.rebuild_points()
 
 
 def delete_group(group_id):
     if type(group_id) is not int:
         # Security measure, because this function can potentially do something
         raise GroupNotFoundError()
-    if not group_exists(group_id):
-        raise GroupNotFoundError()
-    shutil.rmtree(os.path.join(configuration['groups_path'], str(group_id)))
-    adopt_orphans()
+    with locks.catalog_lock.write():
+        if not group_exists(group_id):
+            raise GroupNotFoundError()
+        shutil.rmtree(os.path.join(configuration['groups_path'], str(group_id)))
+        group_tree.refresh(force=True)
+        adopt_orphans()
+    shared_state.bump('catalog')
 
 
 def adopt_orphans():
@@ -729,50 +1072,48 @@ def adopt_orphans():
 def task_exists(task_id):
     if type(task_id) is not int:
         return False
-    return os.access(os.path.join(configuration['tasks_path'], str(task_id), 'task.json'), os.R_OK)
+    return task_catalog.exists(task_id)
 
 
 def group_exists(group_id):
     if type(group_id) is not int:
         return False
-    return os.access(os.path.join(configuration['groups_path'], str(group_id), 'group.json'), os.R_OK)
+    return group_tree.exists(group_id)
 
 
 def allocate_task_id():
     path = configuration['task_maxid_path']
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    try:
-        with open(path) as f:
-            s = f.read()
-            last_task_id = int(s) if s != '' else 0
-        with open(path, 'w') as f:
-            f.write(str(last_task_id + 1))
-        return last_task_id + 1
-    except FileNotFoundError:
-        with open(path, 'w') as f:
-            f.write('1')
-        return 1
+    with locks.catalog_lock.write(), locks.file_lock(path + '.lock'):
+        try:
+            with open(path) as f:
+                s = f.read()
+                last_task_id = int(s) if s != '' else 0
+            with open(path, 'w') as f:
+                f.write(str(last_task_id + 1))
+            return last_task_id + 1
+        except FileNotFoundError:
+            with open(path, 'w') as f:
+                f.write('1')
+            return 1
 
 
 def allocate_group_id():
     path = configuration['group_maxid_path']
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    try:
-        with open(path) as f:
-            s = f.read()
-            last_group_id = int(s) if s != '' else 0
-        with open(path, 'w') as f:
-            f.write(str(last_group_id + 1))
-        return last_group_id + 1
-    except FileNotFoundError:
-        with open(path, 'w') as f:
-            f.write('1')
-        return 1
-
-
-def read_task(task_id, validate=True):
-    if type(task_id) is not int:
-        raise TaskNotFoundError()
+    with locks.catalog_lock.write(), locks.file_lock(path + '.lock'):
+        try:
+            with open(path) as f:
+                s = f.read()
+                last_group_id = int(s) if s != '' else 0
+            with open(path, 'w') as f:
+                f.write(str(last_group_id + 1))
+            return last_group_id + 1
+        except FileNotFoundError:
+            with open(path, 'w') as f:
+                f.write('1')
+            return 1
+
+
+def load_task(task_id):
     task_dir = os.path.join(configuration['tasks_path'], str(task_id))
     task_file = os.path.join(task_dir, 'task.json')
     try:
@@ -780,11 +1121,21 @@ def read_task(task_id, validate=True):
             task_str = f.read()
         os.makedirs(os.path.join(task_dir, 'files'), exist_ok=True)
         task = json.loads(task_str)
-        return Task(task_id, task, validate=validate)
+        return Task(task_id, task, validate=False)
     except FileNotFoundError:
         raise TaskNotFoundError()
 
 
+def read_task(task_id, validate=True):
+    if type(task_id) is not int:
+        raise TaskNotFoundError()
+    # Callers (including task generators) are free to modify the returned task
+    task = copy.deepcopy(task_catalog.get(task_id))
+    if validate:
+        task.validate()
+    return task
+
+
 def write_task(task):
     task_id = task.task_id
     if type(task_id) is not int:
@@ -793,13 +1144,14 @@ def write_task(task):
     os.makedirs(task_dir, exist_ok=True)
     task_file = os.path.join(task_dir, 'task.json')
     obj = task.to_dict(False)
-    with open(task_file, 'w') as f:
-        f.write(json.dumps(obj))
+    with locks.catalog_lock.write():
+        with open(task_file, 'w') as f:
+            f.write(json.dumps(obj))
+        task_catalog.reload(task_id)
+    shared_state.bump('catalog', key=str(task.task_id))
 
 
-def read_group(group_id):
-    if type(group_id) is not int:
-        raise GroupNotFoundError()
+def load_group(group_id):
     group_dir = os.path.join(configuration['groups_path'], str(group_id))
     group_file = os.path.join(group_dir, 'group.json')
     try:
@@ -812,18 +1164,27 @@ def read_group(group_id):
         raise GroupNotFoundError()
 
 
+def read_group(group_id):
+    if type(group_id) is not int:
+        raise GroupNotFoundError()
+    return group_tree.get(group_id)
+
+
 def write_group(group_id, group_dict):
     if type(group_id) is not int:
         raise GroupNotFoundError()
     group_dir = os.path.join(configuration['groups_path'], str(group_id))
     os.makedirs(group_dir, exist_ok=True)
     group_file = os.path.join(group_dir, 'group.json')
-    with open(group_file, 'w') as f:
-        f.write(json.dumps(group_dict))
+    with locks.catalog_lock.write():
+        with open(group_file, 'w') as f:
+            f.write(json.dumps(group_dict))
+        group_tree.refresh(force=True)
+    shared_state.bump('catalog')
 
 
 def has_hint(task_id, hint_hexid, team_name):
-    with closing(sqlite3.connect(configuration['db_path'])) as db:
+    with database.connect() as db:
         cur = db.cursor()
         cur.execute(
             'SELECT rowid FROM hint_purchases WHERE task_id = ? AND hint_hexid = ? AND team_name = ? LIMIT 1',
@@ -833,7 +1194,7 @@ def has_hint(task_id, hint_hexid, team_name):
 
 
 def get_hint_puchases_for_team(team_name):
-    with closing(sqlite3.connect(configuration['db_path'])) as db:
+    with database.connect() as db:
         cur = db.cursor()
         cur.execute(
             'SELECT task_id, hint_hexid, cost FROM hint_purchases WHERE team_name = ?',
@@ -852,24 +1213,31 @@ def find_hint(task, hint_hexid):
 def purchase_hint(task_id, hint_hexid, team_name):
     task = read_task(task_id)
     hint = find_hint(task, hint_hexid)
-    current_team = team.read_team(team_name)
-    if current_team.points < hint['cost']:
-        logger.info(
-            'Team {} tried to purchase hint {} for task {} ({}), but does not have enough points',
-            team_name,
-            hint_hexid,
-            task.title,
-            task_id,
-        )
-        raise NotEnoughPointsError()
 
-    with closing(sqlite3.connect(configuration['db_path'])) as db:
+    with database.connect() as db:
         cur = db.cursor()
-        cur.execute(
-            'INSERT INTO hint_purchases VALUES (?, ?, ?, ?)',
-            (task_id, hint_hexid, team_name, hint['cost']),
-        )
+        if not team.charge_points(cur, team_name, hint['cost']):
+            db.rollback()
+            logger.info(
+                'Team {} tried to purchase hint {} for task {} ({}), but does not have enough points',
+                team_name,
+                hint_hexid,
+                task.title,
+                task_id,
+            )
+            raise NotEnoughPointsError()
+        try:
+            cur.execute(
+                'INSERT INTO hint_purchases VALUES (?, ?, ?, ?)',
+                (task_id, hint_hexid, team_name, hint['cost']),
+            )
+        except sqlite3.IntegrityError:
+            # Bought concurrently by another process, don't charge twice
+            db.rollback()
+            return
         db.commit()
+    scoreboard.add_points(team_name, -hint['cost'])
+    shared_state.bump('scoreboard', key=team_name)
     logger.info(
         'Team {} purchased hint {} for task {} ({})',
         team_name,
@@ -887,12 +1255,13 @@ def get_hint(task_id, hint_hexid):
 def access_hint(task_id, hint_hexid, team_name):
     if type(task_id) is not int:
         raise TypeError('task_id', str(type(task_id)))
-    if not has_hint(task_id, hint_hexid, team_name):
-        purchase_hint(task_id, hint_hexid, team_name)
+    with locks.team_lock(team_name):
+        if not has_hint(task_id, hint_hexid, team_name):
+            purchase_hint(task_id, hint_hexid, team_name)
     return get_hint(task_id, hint_hexid)
 
 
-def api_access_hint(api, sess, args):
+async def api_access_hint(api, sess, args):
     http = args['http_handler']
     request = json.loads(http.request.body)
     task_id    = request['task_id']
@@ -912,7 +1281,7 @@ def api_access_hint(api, sess, args):
             )
         )
 
-    hint = access_hint(task_id=task_id, hint_hexid=hint_hexid, team_name=team_name)
+    hint = await aio.run_in_executor(access_hint, task_id=task_id, hint_hexid=hint_hexid, team_name=team_name)
     http.write(json.dumps({'success': True, 'hint': hint}))
 
 
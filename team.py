@@ -1,14 +1,17 @@
-import sqlite3
 import json
+import sqlite3
 import time
-from contextlib import closing
 from datetime import datetime
 
 from loguru import logger
 
+import auth
+import database
+import locks
 import tasks
 import util
-from configuration import configuration
+from scoreboard import scoreboard
+from shared_state import shared_state
 
 
 class TaskAlreadySolved(Exception):
@@ -32,7 +35,7 @@ class Team:
 
 
 def get_submissions(team_name):
-    with closing(sqlite3.connect(configuration['db_path'])) as db:
+    with database.connect() as db:
         cur = db.cursor()
         cur.execute('SELECT task_id, flag, correct, points FROM submissions WHERE team_name = ?', (team_name,))
         data = cur.fetchall()
@@ -46,7 +49,7 @@ def get_submissions(team_name):
 
 
 def get_all_submissions():
-    with closing(sqlite3.connect(configuration['db_path'], detect_types=sqlite3.PARSE_DECLTYPES)) as db:
+    with database.connect() as db:
         cur = db.cursor()
         cur.execute('SELECT team_name, task_id, flag, correct, points, time FROM submissions')
         data = cur.fetchall()
@@ -60,17 +63,57 @@ def get_all_submissions():
     return result
 
 
-def get_all_teams():
-    with closing(sqlite3.connect(configuration['db_path'], detect_types=sqlite3.PARSE_DECLTYPES)) as db:
+def get_all_teams(with_submissions=False):
+    # Builds all teams from a fixed number of queries. Individual submissions are loaded only
+    # with with_submissions=True, otherwise Team.submissions is None. Teams given to task generators
+    # must always have them, like the ones from read_team()
+    with database.connect() as db:
         cur = db.cursor()
-        cur.execute('SELECT username FROM users')
-        team_names = [i[0] for i in cur.fetchall()]
-    for i in team_names:
-        yield read_team(i)
+        cur.execute('SELECT username, full_name, email, token_seed, is_admin FROM users ORDER BY rowid')
+        users = cur.fetchall()
+        cur.execute('SELECT team_name, earned - spent FROM team_points')
+        points = dict(cur.fetchall())
+        cur.execute('SELECT team_name, task_id, time, points FROM submissions WHERE correct = 1')
+        solve_rows = cur.fetchall()
+        submission_rows = []
+        if with_submissions:
+            cur.execute('SELECT team_name, task_id, flag, correct, points FROM submissions ORDER BY rowid')
+            submission_rows = cur.fetchall()
+
+    existing_tasks = {}
+
+    def task_exists(task_id):
+        if task_id not in existing_tasks:
+            existing_tasks[task_id] = tasks.task_exists(task_id)
+            if not existing_tasks[task_id]:
+                logger.warning('Unable to load submissions: task {} not found', task_id)
+        return existing_tasks[task_id]
+
+    solves = {}
+    for team_name, task_id, solve_time, solve_points in solve_rows:
+        if task_exists(task_id):
+            solves.setdefault(team_name, {})[task_id] = (solve_time, solve_points)
+
+    submissions = {}
+    for team_name, task_id, flag, correct, submission_points in submission_rows:
+        # Same rows as get_submissions()
+        if task_exists(task_id):
+            submissions.setdefault(team_name, []).append((task_id, flag, correct, submission_points))
+
+    for username, full_name, email, seed, is_admin in users:
+        yield Team(username, {
+            'full_name':   full_name,
+            'email':       email,
+            'seed':        seed,
+            'is_admin':    is_admin,
+            'solves':      solves.get(username, {}),
+            'submissions': submissions.get(username, []) if with_submissions else None,
+            'points':      points.get(username, 0),
+        })
 
 
 def get_solves(team_name):
-    with closing(sqlite3.connect(configuration['db_path'], detect_types=sqlite3.PARSE_DECLTYPES)) as db:
+    with database.connect() as db:
         cur = db.cursor()
         cur.execute(
             'SELECT task_id, time, points FROM submissions WHERE team_name = ? AND correct = 1',
@@ -87,22 +130,83 @@ def get_solves(team_name):
 
 
 def get_team_basic_info(team_name):
-    with closing(sqlite3.connect(configuration['db_path'])) as db:
+    with database.connect() as db:
         cur = db.cursor()
         cur.execute(
             'SELECT full_name, email, token_seed, is_admin FROM users WHERE username = ? LIMIT 1',
             (team_name,)
         )
         result = cur.fetchone()
+    if result is None:
+        raise auth.TeamNotFoundError()
     return {'full_name': result[0], 'email': result[1], 'seed': result[2], 'is_admin': result[3]}
 
 
+def get_points(team_name):
+    with database.connect() as db:
+        cur = db.cursor()
+        cur.execute('SELECT earned - spent FROM team_points WHERE team_name = ? LIMIT 1', (team_name,))
+        result = cur.fetchone()
+    return result[0] if result is not None else 0
+
+
+def award_points(cur, team_name, amount):
+    # Must be called inside the transaction that records the reason for the award
+    cur.execute('INSERT OR IGNORE INTO team_points (team_name) VALUES (?)', (team_name,))
+    cur.execute('UPDATE team_points SET earned = earned + ? WHERE team_name = ?', (amount, team_name))
+
+
+def charge_points(cur, team_name, amount):
+    # Must be called inside the transaction that records the purchase. Returns False
+    # (and changes nothing) if the team does not have enough points
+    cur.execute('INSERT OR IGNORE INTO team_points (team_name) VALUES (?)', (team_name,))
+    cur.execute(
+        'UPDATE team_points SET spent = spent + ? WHERE team_name = ? AND earned - spent >= ?',
+        (amount, team_name, amount)
+    )
+    return cur.rowcount > 0
+
+
+def rebuild_points():
+    logger.info('Rebuilding team points ledger')
+    with database.connect() as db:
+        cur = db.cursor()
+        cur.execute('DELETE FROM team_points')
+        cur.execute('''
+            INSERT INTO team_points (team_name, earned, spent)
+            SELECT
+                username,
+                (SELECT COALESCE(SUM(points), 0) FROM submissions WHERE team_name = username),
+                (SELECT COALESCE(SUM(cost), 0) FROM hint_purchases WHERE team_name = username)
+            FROM users
+        ''')
+        db.commit()
+    scoreboard.load(get_all_teams())
+    shared_state.bump('scoreboard')
+
+
+def reload_scoreboard(team_names):
+    # Only the teams changed by other processes are read again, unless it is not known which ones
+    # changed or one of them is new
+    if team_names is not None:
+        for team_name in team_names:
+            try:
+                basic_info = get_team_basic_info(team_name)
+            except auth.TeamNotFoundError:
+                scoreboard.remove_team(team_name)
+                continue
+            if not scoreboard.update_team(team_name, basic_info['full_name'], get_points(team_name), get_solves(team_name)):
+                break
+        else:
+            return
+    scoreboard.load(get_all_teams())
+
+
 def read_team(team_name):
     basic_info = get_team_basic_info(team_name)
     solves = get_solves(team_name)
     submissions = get_submissions(team_name)
-    hint_purchases = tasks.get_hint_puchases_for_team(team_name)
-    points = sum([i[3] for i in submissions]) - sum([i[2] for i in hint_purchases])
+    points = get_points(team_name)
     info = {
         **basic_info,
         'solves': solves,
@@ -113,7 +217,7 @@ def read_team(team_name):
 
 
 def write_team(team):
-    with closing(sqlite3.connect(configuration['db_path'])) as db:
+    with database.connect() as db:
         cur = db.cursor()
         cur.execute('UPDATE users SET full_name = ?, email = ? WHERE username = ?', (
             team.full_name,
@@ -121,10 +225,12 @@ def write_team(team):
             team.team_name
         ))
         db.commit()
+    scoreboard.rename_team(team.team_name, team.full_name)
+    shared_state.bump('scoreboard', key=team.team_name)
 
 
 def add_submission(team_name, task_id, flag, is_correct, points):
-    with closing(sqlite3.connect(configuration['db_path'])) as db:
+    with locks.team_lock(team_name), database.connect() as db:
         cur = db.cursor()
         cur.execute(
             'SELECT rowid FROM submissions WHERE team_name = ? AND task_id = ? and correct = 1',
@@ -132,9 +238,20 @@ def add_submission(team_name, task_id, flag, is_correct, points):
         )
         if len(cur.fetchall()) > 0:
             raise TaskAlreadySolved()
-        cur.execute(
-            'INSERT INTO submissions VALUES (?, ?, ?, ?, ?, ?)',
-            (team_name, task_id, flag, is_correct, points, datetime.now())
-        )
+        try:
+            cur.execute(
+                'INSERT INTO submissions VALUES (?, ?, ?, ?, ?, ?)',
+                (team_name, task_id, flag, is_correct, points, datetime.now())
+            )
+        except sqlite3.IntegrityError:
+            # Solved concurrently by another process, the unique index keeps one correct submission
+            db.rollback()
+            raise TaskAlreadySolved()
+        award_points(cur, team_name, points)
         db.commit()
+    if is_correct:
+        scoreboard.add_points(team_name, points, solved_task_id=task_id)
+        shared_state.bump('scoreboard', key=team_name)
+
 
+shared_state.watch('scoreboard', reload_scoreboard, keyed=True)
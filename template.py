@@ -4,21 +4,54 @@ import os
 import re
 
 from tornado.template import Template, Loader
+from loguru import logger
 
 import configuration as conf
 from localization import lc
 from competition import competition
 
-template_loader = None
+TEMPLATES_PATH = 'templates'
+
+template_loader = Loader(TEMPLATES_PATH)
+templates_signature = None
+
+
+def get_templates_signature():
+    signature = []
+    for entry in os.scandir(TEMPLATES_PATH):
+        if entry.is_file():
+            file_stat = entry.stat()
+            signature.append((entry.name, file_stat.st_mtime_ns, file_stat.st_size))
+    return sorted(signature)
+
+
+def reload_changed_templates():
+    # Only used in debug mode: the Loader keeps compiled templates forever otherwise
+    global templates_signature
+    signature = get_templates_signature()
+    if signature != templates_signature:
+        if templates_signature is not None:
+            logger.info('Templates changed, reloading')
+        template_loader.reset()
+        templates_signature = signature
+
+
+def precompile_templates():
+    count = 0
+    for entry in os.scandir(TEMPLATES_PATH):
+        if entry.is_file() and entry.name.endswith('.html'):
+            template_loader.load(entry.name)
+            count += 1
+    logger.info('Compiled {} templates', count)
+
 
 def render_template(template_name, **kwargs):
-    global template_loader
-    if template_loader is None or True:
-        # XXX: enable template caching
-        template_loader = Loader('templates')
+    if conf.configuration['debug']:
+        reload_changed_templates()
     return template_loader.load(template_name).generate(
         **kwargs,
         lc = lc.get_dict(),
+        locale_script_url = lc.get_script_url(),
         conf = conf.configuration,
         comp = competition,
     )
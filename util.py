@@ -1,38 +1,80 @@
 import os
+import errno
 import secrets
-import importlib
+import shutil
 import time
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 import configuration as conf
 
 
+ctfhost_seed = None
+
+
 def get_ctfhost_seed():
+    global ctfhost_seed
+    if ctfhost_seed is not None:
+        return ctfhost_seed
     path = conf.configuration['ctfhost_seed_path']
     if not os.access(path, os.R_OK):
         seed = secrets.token_hex(16)
         with open(path, 'w') as f:
             f.write(seed)
+        ctfhost_seed = seed
         return seed
     with open(path) as f:
-        return f.read().strip()
+        ctfhost_seed = f.read().strip()
+    return ctfhost_seed
 
 
 def get_current_utc_time():
     return int(time.mktime(time.gmtime()))
 
 
-def import_file(filename, module_name='imported_file'):
-    spec = importlib.util.spec_from_file_location(module_name, filename)
-    mod = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(mod)
-    return mod 
+# ioctl(2) request to share the extents of one file with another (Linux; btrfs, XFS and others)
+FICLONE = 0x40049409
+
+
+def clone_file(src, dst):
+    # Makes dst have the contents of src as cheaply as the filesystem allows: a reflink (copy-on-write,
+    # dst is independent from src), then a hardlink (dst is the same file as src), then a regular copy.
+    # Returns which one was used
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    if fcntl is not None:
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            try:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+                shutil.copystat(src, dst)
+                return 'reflink'
+            except OSError:
+                pass
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+        return 'hardlink'
+    except OSError as e:
+        if e.errno not in {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP}:
+            raise
+    shutil.copy2(src, dst)
+    return 'copy'
 
 
 def make_hash_function(hash_provider):
     return lambda data: hash_provider(read_global_salt() + data)
 
 
+global_salt = None
+
+
 def read_global_salt():
+    global global_salt
+    if global_salt is not None:
+        return global_salt
     salt_path = conf.configuration['global_salt_path']
     os.makedirs(os.path.dirname(salt_path), exist_ok=True)
     if not os.path.exists(salt_path):
@@ -40,7 +82,8 @@ def read_global_salt():
             f.write(make_random_salt())
     
     with open(salt_path, 'rb') as f:
-        return f.read()
+        global_salt = f.read()
+    return global_salt
 
 
 def make_random_salt():